@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# 加载chatbot_tutorial.py里exportScript导出的TorchScript模型并进行对话，它只依赖PyTorch，不需要训练和数据处理的代码。
+# 用法：python chatbot_runtime.py data/save/cb_model/cornell\ movie-dialogs\ corpus/chatbot_scripted.pt
+
+import json
+import re
+import sys
+import unicodedata
+
+import torch
+
+
+# 和chatbot_tutorial.py里的normalizeString一样：变成小写的ASCII，标点前面加空格，去掉字母和.!?之外的字符
+def unicodeToAscii(s):
+    return ''.join(
+        c for c in unicodedata.normalize('NFD', s)
+        if unicodedata.category(c) != 'Mn'
+    )
+
+
+def normalizeString(s):
+    s = unicodeToAscii(s.lower().strip())
+    s = re.sub(r"([.!?])", r" \1", s)
+    s = re.sub(r"[^a-zA-Z.!?]+", r" ", s)
+    s = re.sub(r"\s+", r" ", s).strip()
+    return s
+
+
+class Chatbot:
+    def __init__(self, filename):
+        extra_files = {'voc.txt': '', 'config.json': ''}
+        self.searcher = torch.jit.load(filename, map_location='cpu', _extra_files=extra_files)
+        self.searcher.eval()
+        self.index2word = extra_files['voc.txt'].decode('utf-8').split('\n')
+        self.word2index = {word: index for index, word in enumerate(self.index2word)}
+        config = json.loads(extra_files['config.json'].decode('utf-8'))
+        self.max_length = config['max_length']
+        self.eos_token = config['EOS_token']
+        self.pad_token = config['PAD_token']
+
+    # 返回回复，包含未知词的时候抛出KeyError
+    def reply(self, sentence):
+        indexes = [self.word2index[word] for word in normalizeString(sentence).split(' ')] + [self.eos_token]
+        input_seq = torch.LongTensor(indexes).view(-1, 1)
+        input_length = torch.tensor([len(indexes)])
+        with torch.no_grad():
+            tokens, _ = self.searcher(input_seq, input_length, self.max_length)
+        words = []
+        for token in tokens.tolist():
+            if token == self.eos_token:
+                break
+            if token != self.pad_token:
+                words.append(self.index2word[token])
+        return ' '.join(words)
+
+
+def main(argv):
+    if len(argv) != 2:
+        print('usage: {} model.pt'.format(argv[0]))
+        return 1
+    bot = Chatbot(argv[1])
+    while True:
+        try:
+            input_sentence = input('> ')
+        except EOFError:
+            break
+        if input_sentence == 'q' or input_sentence == 'quit':
+            break
+        try:
+            print('Bot:', bot.reply(input_sentence))
+        except KeyError:
+            print("Error: Encountered unknown word.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -61,8 +61,10 @@ from __future__ import unicode_literals
 import torch
 from torch.jit import script, trace
 import torch.nn as nn
+import torch.distributed as dist
 from torch import optim
 import torch.nn.functional as F
+import numpy as np
 import csv
 import random
 import re
@@ -72,6 +74,22 @@ import codecs
 from io import open
 import itertools
 import math
+import time
+import concurrent.futures
+import io
+import contextlib
+import collections
+import collections.abc
+import hashlib
+import functools
+import multiprocessing
+import asyncio
+import json
+import socket
+import tempfile
+import stat
+import copy
+from array import array
 
 
 USE_CUDA = torch.cuda.is_available()
@@ -99,10 +117,10 @@ corpus_name = "cornell movie-dialogs corpus"
 corpus = os.path.join("data", corpus_name)
 
 def printLines(file, n=10):
+    # 只读取前n行，不需要把整个文件读到内存里
     with open(file, 'rb') as datafile:
-        lines = datafile.readlines()
-    for line in lines[:n]:
-        print(line)
+        for line in itertools.islice(datafile, n):
+            print(line)
 
 printLines(os.path.join(corpus, "movie_lines.txt"))
 
@@ -112,9 +130,9 @@ printLines(os.path.join(corpus, "movie_lines.txt"))
 # 为了使用方便，我们会把原始数据处理成一个新的文件，这个新文件的每一行都是用TAB分割问题(query)和答案(response)对。为了实现这个目的，我们首先定义一些用于parsing原始文件 *movie_lines.txt*  的辅助函数。
 # 
 #  
-# -  ``loadLines`` 把*movie_lines.txt* 文件切分成 (lineID, characterID, movieID, character, text)
-# -  ``loadConversations`` 把上面的行group成一个个多轮的对话
-# -  ``extractSentencePairs`` 从上面的每个对话中抽取句对
+# -  ``loadLines`` 把*movie_lines.txt* 文件切分成 (lineID, characterID, movieID, character, text)，然后把text按列紧凑的保存起来
+# -  ``loadConversations`` 把上面的行group成一个个多轮的对话(generator)
+# -  ``extractSentencePairs`` 从上面的每个对话中抽取句对(generator)
 # 
 # 
 # 
@@ -128,61 +146,75 @@ printLines(os.path.join(corpus, "movie_conversations.txt"))
 # In[4]:
 
 
-# 把每一行都parse成一个dict，key是lineID、characterID、movieID、character和text
-# 分别代表这一行的ID、人物ID、电影ID，人物名称和文本。
-# 最终输出一个dict，key是lineID，value是一个dict。
-# value这个dict的key是lineID、characterID、movieID、character和text
+# movie_lines.txt的每一行有lineID、characterID、movieID、character和text这5个字段，
+# 分别代表这一行的ID、人物ID、电影ID，人物名称和文本。但是后面只会用到lineID和text。
+# 如果每一行都parse成一个dict，那么30万行就需要30万个dict，内存开销很大。
+# 因此我们按列(columnar)来存储：所有行的text拼接成一个bytes缓冲区buffer，
+# offsets[i]和offsets[i+1]是第i行在buffer里的起止位置，index是lineID到行号i的映射。
+class MovieLines:
+    __slots__ = ('index', 'offsets', 'buffer')
+
+    def __init__(self):
+        self.index = {}
+        self.offsets = array('q', [0])
+        self.buffer = bytearray()
+
+    def add(self, lineID, text):
+        self.index[lineID] = len(self.offsets) - 1
+        # 文件是iso-8859-1编码的，每个字符正好是一个字节，因此可以无损的编码和解码。
+        self.buffer += text.encode('iso-8859-1')
+        self.offsets.append(len(self.buffer))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, lineID):
+        i = self.index[lineID]
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].decode('iso-8859-1')
+
+
+# 把每一行切分成fields，只保存lineID和text到MovieLines对象里。
 def loadLines(fileName, fields):
-    lines = {}
+    lines = MovieLines()
+    idField = fields.index("lineID")
+    textField = fields.index("text")
     with open(fileName, 'r', encoding='iso-8859-1') as f:
         for line in f:
             values = line.split(" +++$+++ ")
-            # 抽取fields
-            lineObj = {}
-            for i, field in enumerate(fields):
-                lineObj[field] = values[i]
-            lines[lineObj['lineID']] = lineObj
+            lines.add(values[idField], values[textField])
     return lines
 
 
-# 根据movie_conversations.txt文件和上输出的lines，把utterance组成对话。
-# 最终输出一个list，这个list的每一个元素都是一个dict，key分别是character1ID、character2ID、movieID和utteranceIDs。
-# 分别表示这对话的第一个人物的ID，第二个的ID，电影的ID以及它包含的utteranceIDs
-# 最后根据lines，还给每一行的dict增加一个key为lines，其value是个list，包含所有utterance(上面得到的lines的value)
+# utteranceIDs字段是一个字符串，形如"['L198', 'L199']"，
+# 我们不用eval(它很慢，而且会执行文件里的任意代码)，而是直接切分出其中的lineID，空的list("[]")返回[]。
+def parseUtteranceIDs(s):
+    return [lineId for lineId in (item.strip().strip("'\"") for item in s.strip().strip("[]").split(",")) if lineId]
+
+
+# 根据movie_conversations.txt文件和上面输出的lines，把utterance组成对话。
+# 这是一个generator，每次返回一个对话，也就是这个对话包含的所有utterance的text组成的list。
+# 因为不需要把所有的对话都保存在内存里，所以语料再大也只需要很少的内存。
 def loadConversations(fileName, lines, fields):
-    conversations = []
+    idsField = fields.index("utteranceIDs")
     with open(fileName, 'r', encoding='iso-8859-1') as f:
         for line in f:
             values = line.split(" +++$+++ ")
-            # 抽取fields
-            convObj = {}
-            for i, field in enumerate(fields):
-                convObj[field] = values[i]
-            # convObj["utteranceIDs"]是一个字符串，形如['L198', 'L199']
-            # 我们用eval把这个字符串变成一个字符串的list。
-            lineIds = eval(convObj["utteranceIDs"])
-            # 根据lineIds构造一个数组，根据lineId去lines里检索出存储utterance对象。
-            convObj["lines"] = []
-            for lineId in lineIds:
-                convObj["lines"].append(lines[lineId])
-            conversations.append(convObj)
-    return conversations
-
-
-# 从对话中抽取句对 
+            # 根据lineIds去lines里检索出utterance的文本。
+            yield [lines[lineId] for lineId in parseUtteranceIDs(values[idsField])]
+
+
+# 从对话中抽取句对，这也是一个generator，每次返回一个(问题, 答案)句对。
 # 假设一段对话包含s1,s2,s3,s4这4个utterance
 # 那么会返回3个句对：s1-s2,s2-s3和s3-s4。
 def extractSentencePairs(conversations):
-    qa_pairs = []
     for conversation in conversations:
         # 遍历对话中的每一个句子，忽略最后一个句子，因为没有答案。
-        for i in range(len(conversation["lines"]) - 1): 
-            inputLine = conversation["lines"][i]["text"].strip()
-            targetLine = conversation["lines"][i+1]["text"].strip()
+        for i in range(len(conversation) - 1):
+            inputLine = conversation[i].strip()
+            targetLine = conversation[i+1].strip()
             # 如果有空的句子就去掉 
             if inputLine and targetLine:
-                qa_pairs.append([inputLine, targetLine])
-    return qa_pairs
+                yield [inputLine, targetLine]
 
 
 # 接下来我们利用上面的3个函数对原始数据进行处理，最终得到*formatted_movie_lines.txt*。
@@ -199,27 +231,40 @@ delimiter = '\t'
 # 对分隔符delimiter进行decode，这里对tab进行decode结果并没有变
 delimiter = str(codecs.decode(delimiter, "unicode_escape"))
 
-# 初始化dict lines，list conversations以及前面我们介绍过的field的id数组。
-lines = {}
-conversations = []
+# 前面我们介绍过的field的id数组。
 MOVIE_LINES_FIELDS = ["lineID", "characterID", "movieID", "character", "text"]
 MOVIE_CONVERSATIONS_FIELDS = ["character1ID", "character2ID", "movieID", "utteranceIDs"]
 
-# 首先使用loadLines函数处理movie_lines.txt 
-print("\nProcessing corpus...")
-lines = loadLines(os.path.join(corpus, "movie_lines.txt"), MOVIE_LINES_FIELDS)
-# 接着使用loadConversations处理上一步的结果，得到conversations
-print("\nLoading conversations...")
-conversations = loadConversations(os.path.join(corpus, "movie_conversations.txt"),
-                                  lines, MOVIE_CONVERSATIONS_FIELDS)
-
-# 输出到一个新的csv文件
-print("\nWriting newly formatted file...")
-with open(datafile, 'w', encoding='utf-8') as outputfile:
-    writer = csv.writer(outputfile, delimiter=delimiter, lineterminator='\n')
-    # 使用extractSentencePairs从conversations里抽取句对。
-    for pair in extractSentencePairs(conversations):
-        writer.writerow(pair)
+# 原始文件
+sourcefiles = [os.path.join(corpus, "movie_lines.txt"), os.path.join(corpus, "movie_conversations.txt")]
+
+# 如果target文件存在并且比所有的sources文件都新，那么就不需要重新生成了(类似make)。
+def isUpToDate(target, sources):
+    if not os.path.exists(target):
+        return False
+    return all(os.path.getmtime(source) <= os.path.getmtime(target) for source in sources)
+
+if isUpToDate(datafile, sourcefiles):
+    print("\nFormatted file is up to date, skip processing corpus.")
+else:
+    # 首先使用loadLines函数处理movie_lines.txt 
+    print("\nProcessing corpus...")
+    lines = loadLines(sourcefiles[0], MOVIE_LINES_FIELDS)
+    # 接着使用loadConversations处理上一步的结果，得到conversations
+    # 注意conversations是一个generator，真正的读取是在下面写文件的时候边读边写的。
+    print("\nLoading conversations...")
+    conversations = loadConversations(sourcefiles[1], lines, MOVIE_CONVERSATIONS_FIELDS)
+
+    # 输出到一个新的csv文件
+    print("\nWriting newly formatted file...")
+    n_pairs = 0
+    with open(datafile, 'w', encoding='utf-8') as outputfile:
+        writer = csv.writer(outputfile, delimiter=delimiter, lineterminator='\n')
+        # 使用extractSentencePairs从conversations里抽取句对。
+        for pair in extractSentencePairs(conversations):
+            writer.writerow(pair)
+            n_pairs += 1
+    print("Wrote {} pairs from {} lines".format(n_pairs, len(lines)))
 
 # 输出一些行用于检查 
 print("\nSample lines from file:")
@@ -236,6 +281,8 @@ printLines(datafile)
 # 
 # 为此，我们会定义一个``Voc``类，它会保存词到ID的映射，同时也保存反向的从ID到词的映射。除此之外，它还记录每个词出现的次数，以及总共出现的词的个数。这个类提供``addWord``方法来增加一个词， ``addSentence``方法来增加句子，也提供方法``trim``来去除低频的词。
 # 
+# 为了节省内存，词频保存在一个numpy数组``counts``里(``word2count``是它的一个dict视图)，``index2word``是一个list。这样``trim``可以用向量化的操作完成，并且返回旧ID到新ID的映射；词典也可以用``save``和``load``保存成紧凑的二进制格式，而不是pickle整个``__dict__``。
+# 
 # 
 # 
 
@@ -247,53 +294,133 @@ PAD_token = 0  # 表示padding
 SOS_token = 1  # 句子的开始 
 EOS_token = 2  # 句子的结束 
 
+# 词频的dict视图，voc.word2count[word]返回word的词频，实际的数据保存在voc.counts数组里。
+class WordCounts(collections.abc.Mapping):
+    def __init__(self, voc):
+        self.voc = voc
+
+    def __getitem__(self, word):
+        return int(self.voc.counts[self.voc.word2index[word]])
+
+    def __iter__(self):
+        return iter(self.voc.word2index)
+
+    def __len__(self):
+        return len(self.voc.word2index)
+
+
 class Voc:
     def __init__(self, name):
         self.name = name
         self.trimmed = False
         self.word2index = {}
-        self.word2count = {}
-        self.index2word = {PAD_token: "PAD", SOS_token: "SOS", EOS_token: "EOS"}
+        # index2word是一个list，下标就是词的ID
+        self.index2word = ["PAD", "SOS", "EOS"]
+        # counts是一个numpy数组，counts[i]是ID为i的词的词频(PAD, SOS, EOS的词频是0)
+        # 它的长度会按照2倍增长，只有前num_words个是有效的
+        self.counts = np.zeros(1024, dtype=np.int64)
         self.num_words = 3  # 目前有SOS, EOS, PAD这3个token。
 
+    @property
+    def word2count(self):
+        return WordCounts(self)
+
     def addSentence(self, sentence):
         for word in sentence.split(' '):
             self.addWord(word)
 
-    def addWord(self, word):
-        if word not in self.word2index:
-            self.word2index[word] = self.num_words
-            self.word2count[word] = 1
-            self.index2word[self.num_words] = word
+    # 增加一个词，词频加count，返回它的ID
+    def addWord(self, word, count=1):
+        index = self.word2index.get(word)
+        if index is None:
+            index = self.num_words
+            self.word2index[word] = index
+            self.index2word.append(word)
             self.num_words += 1
-        else:
-            self.word2count[word] += 1
+            if index >= len(self.counts):
+                self.counts = np.concatenate((self.counts, np.zeros_like(self.counts)))
+        self.counts[index] += count
+        return index
+
+    # 根据词ID的数组重新统计词频
+    def countTokens(self, tokens):
+        self.counts = np.bincount(tokens, minlength=self.num_words).astype(np.int64)
 
     # 删除频次小于min_count的token 
+    # 返回一个数组remap，remap[旧的ID]是新的ID，被删除的词是-1，这样就可以用remap[ids]把旧的ID数组变成新的ID。
     def trim(self, min_count):
         if self.trimmed:
-            return
+            return None
         self.trimmed = True
 
-        keep_words = []
-
-        for k, v in self.word2count.items():
-            if v >= min_count:
-                keep_words.append(k)
+        counts = self.counts[:self.num_words]
+        # 特殊的token总是保留
+        keep = counts >= min_count
+        keep[:3] = True
+        n_keep = int(keep.sum())
 
         print('keep_words {} / {} = {:.4f}'.format(
-            len(keep_words), len(self.word2index), len(keep_words) / len(self.word2index)
+            n_keep - 3, self.num_words - 3, (n_keep - 3) / (self.num_words - 3)
         ))
 
-        # 重新构造词典 
-        self.word2index = {}
-        self.word2count = {}
-        self.index2word = {PAD_token: "PAD", SOS_token: "SOS", EOS_token: "EOS"}
-        self.num_words = 3 # Count default tokens
-        
-        # 重新构造后词频就没有意义了(都是1)
-        for word in keep_words:
-            self.addWord(word)
+        remap = np.full(self.num_words, -1, dtype=np.int64)
+        remap[keep] = np.arange(n_keep)
+
+        # 重新构造词典，保留的词的相对顺序不变，词频也保留下来(后面的采样等需要用到)
+        self.index2word = list(itertools.compress(self.index2word, keep.tolist()))
+        self.word2index = {word: index for index, word in enumerate(self.index2word) if index >= 3}
+        self.counts = counts[keep]
+        self.num_words = n_keep
+        return remap
+
+    # 把词典保存成二进制的格式(npz)，fileName也可以是一个file对象。
+    # 所有的词用utf-8编码后拼接成一个bytes数组，offsets记录每个词的起止位置。
+    def save(self, fileName):
+        encoded = [word.encode('utf-8') for word in self.index2word]
+        offsets = np.zeros(self.num_words + 1, dtype=np.int64)
+        np.cumsum([len(word) for word in encoded], out=offsets[1:])
+        with (open(fileName, 'wb') if isinstance(fileName, str) else contextlib.nullcontext(fileName)) as f:
+            np.savez(f, name=np.array(self.name), trimmed=np.array(self.trimmed),
+                     counts=self.counts[:self.num_words],
+                     words=np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets=offsets)
+
+    @classmethod
+    def load(cls, fileName):
+        with np.load(fileName) as data:
+            voc = cls(str(data['name']))
+            voc.trimmed = bool(data['trimmed'])
+            words = data['words'].tobytes()
+            offsets = data['offsets'].tolist()
+            voc.index2word = [words[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+            voc.word2index = {word: index for index, word in enumerate(voc.index2word) if index >= 3}
+            voc.counts = data['counts'].copy()
+            voc.num_words = len(voc.index2word)
+        return voc
+
+    # 用于把词典保存到checkpoint里
+    def toBytes(self):
+        f = io.BytesIO()
+        self.save(f)
+        return f.getvalue()
+
+    @classmethod
+    def fromBytes(cls, data):
+        return cls.load(io.BytesIO(data))
+
+    # 原来的checkpoint里保存的是voc.__dict__，index2word是ID到词的dict，word2count是词到词频的dict
+    @classmethod
+    def fromDict(cls, state):
+        voc = cls(state['name'])
+        voc.trimmed = state['trimmed']
+        voc.index2word = [state['index2word'][index] for index in range(state['num_words'])]
+        voc.word2index = {word: index for index, word in enumerate(voc.index2word) if index >= 3}
+        voc.counts = np.zeros(state['num_words'], dtype=np.int64)
+        for word, count in state['word2count'].items():
+            index = voc.word2index.get(word)
+            if index is not None:
+                voc.counts[index] = count
+        voc.num_words = state['num_words']
+        return voc
 
 
 # 有了上面的Voc类我们就可以通过问答句对来构建词典了。但是在构建之前我们需要进行一些预处理。
@@ -329,52 +456,174 @@ def normalizeString(s):
     s = re.sub(r"\s+", r" ", s).strip()
     return s
 
+# 上面的normalizeString每次调用都要经过re.sub的正则缓存查找，并且对每个字符都调用一次unicodedata.category，
+# 因此比较慢。下面的normalizeStringFast的输出和normalizeString完全一样，但是：
+# 1) ASCII字符串在NFD分解之后不会变，因此直接跳过unicodeToAscii。
+# 2) 非ASCII字符串NFD分解之后，用str.translate一次性删掉所有的Mn(重音等组合字符)。
+#    翻译表是lazy构造的，只有第一次遇到某个字符才调用unicodedata.category。
+# 3) 三次re.sub的效果等价于找出所有的"词"，然后用一个空格把它们连接起来，所以只需要一个预先编译好的正则表达式。
+#    因为只在标点(.!?)的前面加了空格，所以一个"词"是一个标点，或者是(可能以一个标点开头的)字母串，比如"a.b"会变成"a .b"。
+# 4) 用lru_cache缓存最近的结果，因为对话里"yes ."、"what ?"这样的句子会反复出现。
+class CombiningMarks(dict):
+    def __missing__(self, c):
+        # 返回None表示str.translate删除这个字符，否则保持不变
+        value = None if unicodedata.category(chr(c)) == 'Mn' else c
+        self[c] = value
+        return value
+
+combiningMarks = CombiningMarks()
+tokenPattern = re.compile(r"[.!?]?[a-zA-Z]+|[.!?]")
+
+@functools.lru_cache(maxsize=65536)
+def normalizeStringFast(s):
+    s = s.lower().strip()
+    if not s.isascii():
+        s = unicodedata.normalize('NFD', s).translate(combiningMarks)
+    return ' '.join(tokenPattern.findall(s))
+
+# 检查两个实现的输出是否一样，返回不一样的句子
+def checkNormalizers(sentences):
+    return [s for s in sentences if normalizeStringFast(s) != normalizeString(s)]
+
+# 每行用tab切分成问答两个句子，然后调用normalize函数(默认是normalizeStringFast)进行处理。
+# 多进程的时候这个函数在子进程里执行，每次处理一个chunk的行。
+def normalizeLines(lines, normalize=normalizeStringFast):
+    return [[normalize(s) for s in l.split('\t')] for l in lines]
+
 # 读取问答句对并且返回Voc词典对象 
-def readVocs(datafile, corpus_name):
+# 如果n_workers大于1，那么把所有行切分成大小为chunk_size的chunk，用n_workers个进程并行的归一化。
+# pool.imap会按照chunk的顺序返回结果，因此输出的顺序和单进程是完全一样的。
+def readVocs(datafile, corpus_name, n_workers=1, chunk_size=10000, normalize=normalizeStringFast):
     print("Reading lines...")
     # 文件每行读取到list lines中。 
     lines = open(datafile, encoding='utf-8').        read().strip().split('\n')
-    # 每行用tab切分成问答两个句子，然后调用normalizeString函数进行处理。
-    pairs = [[normalizeString(s) for s in l.split('\t')] for l in lines]
+    start = time.time()
+    # 子进程使用fork的方式创建，这样它们不需要重新import(也就是重新执行)这个脚本。
+    # 没有fork的平台(比如Windows)只能单进程处理。
+    if n_workers > 1 and len(lines) > chunk_size and 'fork' in multiprocessing.get_all_start_methods():
+        chunks = [lines[i:i + chunk_size] for i in range(0, len(lines), chunk_size)]
+        with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+            pairs = [pair for chunk in pool.imap(functools.partial(normalizeLines, normalize=normalize), chunks)
+                     for pair in chunk]
+    else:
+        n_workers = 1
+        pairs = normalizeLines(lines, normalize)
+    elapsed = time.time() - start
+    print("Normalized {} lines in {:.2f}s ({:.0f} lines/s, {} workers)".format(
+        len(lines), elapsed, len(lines) / max(elapsed, 1e-9), n_workers))
     voc = Voc(corpus_name)
     return voc, pairs
 
-def filterPair(p): 
-    return len(p[0].split(' ')) < MAX_LENGTH and len(p[1].split(' ')) < MAX_LENGTH
+# 预处理后的句对，词ID拼接成一个一维数组tokens，offsets记录每个句子的起止位置。
+# 它支持len和下标访问，pairs[i]返回第i个句对(问题和答案的字符串)，因此可以像list一样使用。
+class TokenizedPairs:
+    def __init__(self, tokens, offsets, voc):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.voc = voc
+
+    def __len__(self):
+        return (len(self.offsets) - 1) // 2
+
+    # 第k个句子的词ID
+    def sentence(self, k):
+        return self.tokens[self.offsets[k]:self.offsets[k + 1]]
+
+    # 第i个句对的词ID
+    def ids(self, i):
+        return self.sentence(2 * i), self.sentence(2 * i + 1)
+
+    def __getitem__(self, i):
+        return [' '.join(self.voc.index2word[index] for index in ids.tolist()) for ids in self.ids(i)]
+
+    # 返回一个新的TokenizedPairs，只包含keep_pairs[i]为True的句对。
+    # tokens是可选的，用于同时替换词ID(比如trim之后的新ID)，它的shape和self.tokens一样。
+    def select(self, keep_pairs, tokens=None):
+        if tokens is None:
+            tokens = self.tokens
+        lengths = np.diff(self.offsets)
+        keep_sentences = np.repeat(keep_pairs, 2)
+        offsets = np.zeros(2 * int(keep_pairs.sum()) + 1, dtype=np.int64)
+        np.cumsum(lengths[keep_sentences], out=offsets[1:])
+        tokens = tokens[np.repeat(keep_sentences, lengths)].astype(np.int32)
+        return TokenizedPairs(tokens, offsets, self.voc)
+
+    # 保存到directory目录，最后才写key文件，所以如果中途失败，缓存是无效的。
+    def save(self, directory, key):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        keyfile = os.path.join(directory, "key")
+        if os.path.exists(keyfile):
+            os.remove(keyfile)
+        np.save(os.path.join(directory, "tokens.npy"), self.tokens)
+        np.save(os.path.join(directory, "offsets.npy"), self.offsets)
+        self.voc.save(os.path.join(directory, "voc.bin"))
+        with open(keyfile, 'w', encoding='utf-8') as f:
+            f.write(key)
+
+    # 从directory目录加载，如果缓存不存在或者key不一致，返回None。
+    @classmethod
+    def load(cls, directory, key, mmap_mode='r'):
+        keyfile = os.path.join(directory, "key")
+        if not os.path.exists(keyfile):
+            return None
+        with open(keyfile, encoding='utf-8') as f:
+            if f.read() != key:
+                return None
+        tokens = np.load(os.path.join(directory, "tokens.npy"), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode=mmap_mode)
+        voc = Voc.load(os.path.join(directory, "voc.bin"))
+        return cls(tokens, offsets, voc)
+
+
+# 把字符串的句对变成TokenizedPairs，同时把新的词加到voc里(但是不统计词频)
+def encodePairs(voc, pairs):
+    word2index = voc.word2index
+    tokens = array('i')
+    offsets = array('q', [0])
+    for pair in pairs:
+        for sentence in pair:
+            tokens.extend([word2index[word] if word in word2index else voc.addWord(word, 0)
+                           for word in sentence.split(' ')])
+            offsets.append(len(tokens))
+    return TokenizedPairs(np.frombuffer(tokens, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64), voc)
 
-# 过滤太长的句对 
+# 过滤太长的句对，返回一个bool数组，表示每个句对的两个句子是否都小于MAX_LENGTH
 def filterPairs(pairs):
-    return [pair for pair in pairs if filterPair(pair)]
+    lengths = np.diff(pairs.offsets)
+    return (lengths[0::2] < MAX_LENGTH) & (lengths[1::2] < MAX_LENGTH)
 
-# 使用上面的函数进行处理，返回Voc对象和句对的list 
-def loadPrepareData(corpus, corpus_name, datafile):
+# 使用上面的函数进行处理，返回Voc对象和TokenizedPairs
+# 注意词频只统计长度合适的句对，太长的句对会在后面的trimRareWords里去掉。
+def loadPrepareData(corpus, corpus_name, datafile, n_workers=1):
     print("Start preparing training data ...")
-    voc, pairs = readVocs(datafile, corpus_name)
+    voc, pairs = readVocs(datafile, corpus_name, n_workers)
     print("Read {!s} sentence pairs".format(len(pairs)))
-    pairs = filterPairs(pairs)
-    print("Trimmed to {!s} sentence pairs".format(len(pairs)))
+    pairs = encodePairs(voc, pairs)
+    keep_pairs = filterPairs(pairs)
+    print("Trimmed to {!s} sentence pairs".format(int(keep_pairs.sum())))
     print("Counting words...")
-    for pair in pairs:
-        voc.addSentence(pair[0])
-        voc.addSentence(pair[1])
+    voc.countTokens(pairs.tokens[np.repeat(np.repeat(keep_pairs, 2), np.diff(pairs.offsets))])
     print("Counted words:", voc.num_words)
     return voc, pairs
 
 
 # Load/Assemble voc and pairs
 save_dir = os.path.join("data", "save")
-voc, pairs = loadPrepareData(corpus, corpus_name, datafile)
-# 输出一些句对
-print("\npairs:")
-for pair in pairs[:10]:
-    print(pair)
+# 归一化使用的进程数，默认使用所有的CPU核
+n_workers = os.cpu_count() or 1
+# 检查normalizeStringFast和normalizeString在语料和一些特殊的句子上的输出完全一样
+with open(datafile, encoding='utf-8') as f:
+    sample_sentences = [s for l in itertools.islice(f, 10000) for s in l.rstrip('\n').split('\t')]
+sample_sentences += ["Café? Naïve...", "  Hello,  World!! ", "a.b?c..d", "don't\tstop", "Über-cool ß İ", "", "?!."]
+assert not checkNormalizers(sample_sentences)
 
 
 # 另外为了收敛更快，我们可以去除掉一些低频词。这可以分为两步：
 # 
 # 1) 使用``voc.trim``函数去掉频次低于``MIN_COUNT`` 的词。
 # 
-# 2) 去掉包含低频词的句子(只保留这样的句子——每一个词都是高频的，也就是在voc中出现的)
+# 2) 去掉包含低频词的句子(只保留这样的句子——每一个词都是高频的，也就是在voc中出现的)，同时去掉太长的句子
 # 
 # 
 
@@ -384,37 +633,76 @@ for pair in pairs[:10]:
 MIN_COUNT = 3    # 阈值为3
 
 
+# 句对的词都已经变成了ID，因此不需要逐个词的去查词典，而是用向量化的方法一次处理所有的句对：
+# 1) voc.trim返回旧ID到新ID的映射remap，低频词是-1，remap[pairs.tokens]就得到所有词的新ID。
+# 2) 对"是否低频词"求前缀和，这样用offsets就可以得到每个句子包含的低频词的个数。
+# 3) 问题和答案都不包含低频词并且都不太长，我们才保留这个句对。
 def trimRareWords(voc, pairs, MIN_COUNT):
     # 去掉voc中频次小于3的词 
-    voc.trim(MIN_COUNT)
-    # 保留的句对 
-    keep_pairs = []
-    for pair in pairs:
-        input_sentence = pair[0]
-        output_sentence = pair[1]
-        keep_input = True
-        keep_output = True
-        # 检查问题
-        for word in input_sentence.split(' '):
-            if word not in voc.word2index:
-                keep_input = False
-                break
-        # 检查答案
-        for word in output_sentence.split(' '):
-            if word not in voc.word2index:
-                keep_output = False
-                break
+    remap = voc.trim(MIN_COUNT)
+    if remap is None:
+        remap = np.arange(voc.num_words)
+    tokens = remap[pairs.tokens]
+    rare = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum(tokens < 0, out=rare[1:])
+    keep_sentences = rare[pairs.offsets[1:]] == rare[pairs.offsets[:-1]]
+    # 如果问题和答案都只包含高频词，并且长度都小于MAX_LENGTH，我们才保留这个句对
+    keep_pairs = keep_sentences[0::2] & keep_sentences[1::2] & filterPairs(pairs)
+    keep = pairs.select(keep_pairs, tokens)
 
-        # 如果问题和答案都只包含高频词，我们才保留这个句对
-        if keep_input and keep_output:
-            keep_pairs.append(pair)
+    print("Trimmed from {} pairs to {}, {:.4f} of total".format(len(pairs), len(keep), len(keep) / len(pairs)))
+    return keep
 
-    print("Trimmed from {} pairs to {}, {:.4f} of total".format(len(pairs), len(keep_pairs), len(keep_pairs) / len(pairs)))
-    return keep_pairs
+
+# ### 缓存预处理的结果
+# 
+# 上面的预处理(读取*formatted_movie_lines.txt*、归一化、构建词典和去掉低频词)每次运行都要对整个语料处理一遍，
+# 语料很大的时候训练要等很久才能开始。但是只要原始文件、``MAX_LENGTH``和``MIN_COUNT``不变，结果就是一样的。
+# 因此我们把预处理的结果保存成二进制的格式：所有句子的词ID拼接成一个一维的整数数组``tokens``，
+# 另外用一个数组``offsets``记录每个句子的起止位置，第i个句对的问题是第2i个句子，答案是第2i+1个句子。词典也保存在同一个目录下。
+# 
+# 下一次运行的时候直接用``np.load(..., mmap_mode='r')``把数组memory-map进来，操作系统只有在真正访问的时候才会读取数据，
+# 因此加载的时间和语料的大小无关。缓存目录下的key文件记录了原始文件(大小和修改时间)、``MAX_LENGTH``和``MIN_COUNT``的hash，
+# 只要它们有变化，缓存就会自动失效并且重新生成。
+# 
+# 
+
+# In[ ]:
+
+
+# 缓存格式的版本，格式变化的时候需要加一，这样旧的缓存就会失效
+CACHE_VERSION = 2
+
+# 根据原始文件的大小和修改时间以及预处理的参数计算缓存的key
+def cacheKey(sources, max_length, min_count):
+    h = hashlib.sha1()
+    for source in sources:
+        st = os.stat(source)
+        h.update('{}:{}:{}\n'.format(os.path.basename(source), st.st_size, st.st_mtime_ns).encode('utf-8'))
+    h.update('{}:{}:{}'.format(CACHE_VERSION, max_length, min_count).encode('utf-8'))
+    return h.hexdigest()
+
+
+# 如果缓存有效就直接加载，否则进行预处理然后保存到缓存里
+def loadTrainingData(corpus, corpus_name, datafile, save_dir, n_workers=1):
+    cache_dir = os.path.join(save_dir, "cache", corpus_name)
+    key = cacheKey(sourcefiles + [datafile], MAX_LENGTH, MIN_COUNT)
+    pairs = TokenizedPairs.load(cache_dir, key)
+    if pairs is not None:
+        print("Loaded {} pairs and {} words from cache {}".format(len(pairs), pairs.voc.num_words, cache_dir))
+        return pairs.voc, pairs
+    voc, pairs = loadPrepareData(corpus, corpus_name, datafile, n_workers)
+    pairs = trimRareWords(voc, pairs, MIN_COUNT)
+    pairs.save(cache_dir, key)
+    return voc, pairs
 
 
 # 实际进行处理
-pairs = trimRareWords(voc, pairs, MIN_COUNT)
+voc, pairs = loadTrainingData(corpus, corpus_name, datafile, save_dir, n_workers)
+# 输出一些句对
+print("\npairs:")
+for i in range(min(10, len(pairs))):
+    print(pairs[i])
 
 
 # ### 为模型准备数据
@@ -430,11 +718,11 @@ pairs = trimRareWords(voc, pairs, MIN_COUNT)
 #  
 # 因此我们会用一些工具函数来实现上述处理。
 # 
-# ``inputVar``函数把batch个句子padding后变成一个LongTensor，大小是(max_length, batch)，同时会返回一个大小是batch的list lengths，说明每个句子的实际长度，这个参数后面会传给PyTorch，从而在forward和backward计算的时候使用实际的长度。
+# ``padTokens``函数把batch个句子(词ID)加上EOS之后padding成一个LongTensor，大小是(max_length, batch)，同时会返回一个大小是batch的tensor lengths，说明每个句子的实际长度，这个参数后面会传给PyTorch，从而在forward和backward计算的时候使用实际的长度。它先分配好(max_length, batch)的tensor，然后用numpy的高级下标一次把所有的词ID填进去，而不需要在Python里逐个位置的处理。
 # 
-# ``outputVar``函数和``inputVar``类似，但是它输出的第二个参数不是lengths，而是一个大小为(max_length, batch)的mask矩阵(tensor)，某位是0表示这个位置是padding，1表示不是padding，这样做的目的是后面计算方便。当然这两种表示是等价的，只不过lengths表示更加紧凑，但是计算起来不同方便，而mask矩阵和outputVar直接相乘就可以把padding的位置给mask(变成0)掉，这在计算loss时会非常方便。
+# 对于答案，除了padding后的tensor，我们还需要一个大小为(max_length, batch)的mask矩阵(tensor)，某位是False表示这个位置是padding，True表示不是padding，这样做的目的是后面计算方便。当然lengths和mask这两种表示是等价的，只不过lengths表示更加紧凑，但是计算起来不同方便，而mask可以直接把padding的位置给mask掉，这在计算loss时会非常方便。mask只需要把padding后的tensor和PAD_token比较一次就可以得到。
 # 
-# ``batch2TrainData`` 则利用上面的两个函数把一个batch的句对处理成合适的输入和输出Tensor。
+# ``indexes2TrainData`` 则利用``padTokens``把一个batch的句对(``TokenizedPairs``里的下标)处理成合适的输入和输出Tensor，``batch2TrainData``的输入是字符串的句对，它先把句子变成ID，然后再调用``indexes2TrainData``。
 # 
 # 
 # 
@@ -446,58 +734,44 @@ pairs = trimRareWords(voc, pairs, MIN_COUNT)
 def indexesFromSentence(voc, sentence):
     return [voc.word2index[word] for word in sentence.split(' ')] + [EOS_token]
 
-# l是多个长度不同句子(list)，使用zip_longest padding成定长，长度为最长句子的长度。
-def zeroPadding(l, fillvalue=PAD_token):
-    return list(itertools.zip_longest(*l, fillvalue=fillvalue))
-
-# l是二维的padding后的list
-# 返回m和l的大小一样，如果某个位置是padding，那么值为0，否则为1
-def binaryMatrix(l, value=PAD_token):
-    m = []
-    for i, seq in enumerate(l):
-        m.append([])
-        for token in seq:
-            if token == PAD_token:
-                m[i].append(0)
-            else:
-                m[i].append(1)
-    return m
-
-# 把输入句子变成ID，然后再padding，同时返回lengths这个list，标识实际长度。
-# 返回的padVar是一个LongTensor，shape是(batch, max_length)，
-# lengths是一个list，长度为(batch,)，表示每个句子的实际长度。
-def inputVar(l, voc):
-    indexes_batch = [indexesFromSentence(voc, sentence) for sentence in l]
-    lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
-    padList = zeroPadding(indexes_batch)
-    padVar = torch.LongTensor(padList)
-    return padVar, lengths
-
-# 对输出句子进行padding，然后用binaryMatrix得到每个位置是padding(0)还是非padding，
-# 同时返回最大最长句子的长度(也就是padding后的长度)
-# 返回值padVar是LongTensor，shape是(batch, max_target_length)
-# mask是ByteTensor，shape也是(batch, max_target_length)
-def outputVar(l, voc):
-    indexes_batch = [indexesFromSentence(voc, sentence) for sentence in l]
-    max_target_len = max([len(indexes) for indexes in indexes_batch])
-    padList = zeroPadding(indexes_batch)
-    mask = binaryMatrix(padList)
-    mask = torch.ByteTensor(mask)
-    padVar = torch.LongTensor(padList)
-    return padVar, mask, max_target_len
-
-# 处理一个batch的pair句对 
-def batch2TrainData(voc, pair_batch):
-    # 按照Q(QA里边的问句)句子的长度(词数)排序
-    pair_batch.sort(key=lambda x: len(x[0].split(" ")), reverse=True)
-    input_batch, output_batch = [], []
-    for pair in pair_batch:
-        input_batch.append(pair[0])
-        output_batch.append(pair[1])
-    inp, lengths = inputVar(input_batch, voc)
-    output, mask, max_target_len = outputVar(output_batch, voc)
+# 把batch个句子tokens[starts[i]:ends[i]]加上EOS，然后padding成一个(max_length, batch)的LongTensor，
+# 同时返回每个句子的实际长度(包括EOS)。
+def padTokens(tokens, starts, ends):
+    n_words = ends - starts
+    lengths = n_words + 1
+    padded = torch.full((int(lengths.max()), len(starts)), PAD_token, dtype=torch.long)
+    # 第i个句子的第t个词放到padded[t, i]，它在tokens里的下标是starts[i] + t
+    # 把所有句子的词拼接起来，first[i]是第i个句子的第一个词在拼接后的位置
+    first = np.cumsum(n_words) - n_words
+    cols = np.repeat(np.arange(len(starts)), n_words)
+    rows = np.arange(n_words.sum()) - np.repeat(first, n_words)
+    # padded和padded.numpy()共享内存，所以直接修改numpy数组就可以
+    view = padded.numpy()
+    view[rows, cols] = tokens[np.repeat(starts, n_words) + rows]
+    view[n_words, np.arange(len(starts))] = EOS_token
+    return padded, torch.from_numpy(lengths)
+
+# 处理一个batch的pair句对，indices是句对在pairs(TokenizedPairs)里的下标
+def indexes2TrainData(pairs, indices):
+    offsets = pairs.offsets
+    indices = np.asarray(indices)
+    # 按照Q(QA里边的问句)句子的长度(词数)排序，稳定排序保证长度相同的句对的顺序不变
+    input_lengths = offsets[2 * indices + 1] - offsets[2 * indices]
+    indices = indices[np.argsort(-input_lengths, kind='stable')]
+    inp, lengths = padTokens(pairs.tokens, offsets[2 * indices], offsets[2 * indices + 1])
+    output, output_lengths = padTokens(pairs.tokens, offsets[2 * indices + 1], offsets[2 * indices + 2])
+    mask = output != PAD_token
+    max_target_len = int(output_lengths.max())
     return inp, lengths, output, mask, max_target_len
 
+# 处理一个batch的pair句对(字符串)
+def batch2TrainData(voc, pair_batch):
+    indexes_batch = [[voc.word2index[word] for word in sentence.split(' ')] for pair in pair_batch for sentence in pair]
+    offsets = np.zeros(len(indexes_batch) + 1, dtype=np.int64)
+    np.cumsum([len(indexes) for indexes in indexes_batch], out=offsets[1:])
+    tokens = np.fromiter(itertools.chain.from_iterable(indexes_batch), dtype=np.int32, count=int(offsets[-1]))
+    return indexes2TrainData(TokenizedPairs(tokens, offsets, voc), np.arange(len(pair_batch)))
+
 
 # 示例
 small_batch_size = 5
@@ -511,6 +785,108 @@ print("mask:", mask)
 print("max_target_len:", max_target_len)
 
 
+# ### 按长度分桶的batch
+# 
+# 前面提到，每次随机的从所有pair里选择batch个数据，那么一个9个词的句子经常会和2个词的句子在同一个batch里，
+# GRU和attention的大部分计算都浪费在了PAD上。``BucketBatchSampler``把长度(问题长度和答案长度)相同或者接近的句对放到同一个batch里：
+# 每个epoch先把所有句对随机打乱，然后按照(问题长度, 答案长度)稳定排序，这样相同长度的句对的顺序仍然是随机的，
+# 接着每batch_size个句对组成一个batch，最后再把所有batch的顺序打乱。每个epoch的随机种子不同，因此每个epoch的batch都不一样。
+# 
+# 采样器返回的是一个batch的句对的下标，``RandomBatchSampler``是原来的随机采样方法，它们的接口是一样的。
+# ``paddingRatio``计算一些batch里PAD占所有位置的比例。
+# 
+# 采样器的第i个batch只由随机种子和i决定，因此``batches(start)``可以直接从第start个batch开始，从checkpoint恢复训练的时候不需要重新生成前面的batch。
+# 
+# 另外原来的``trainIters``会在训练之前把n_iteration个batch全部构造好，n_iteration很大的时候需要很多内存，而且要等很久才能开始训练。
+# ``prefetchBatches``是一个generator，它用后台的线程池构造batch，最多提前构造prefetch个，这样构造batch和训练可以同时进行。
+# 
+# 
+
+# In[ ]:
+
+
+# 原来的采样方法：每次有放回的随机选择batch_size个句对
+class RandomBatchSampler:
+    def __init__(self, pairs, batch_size, seed=0):
+        self.n_pairs = len(pairs)
+        self.batch_size = batch_size
+        self.seed = seed
+
+    # 从第start个batch开始返回，每个batch的随机种子是(seed, 下标)
+    def batches(self, start=0):
+        for i in itertools.count(start):
+            yield np.random.RandomState([self.seed, i]).randint(self.n_pairs, size=self.batch_size)
+
+    def __iter__(self):
+        return self.batches()
+
+
+class BucketBatchSampler:
+    def __init__(self, pairs, batch_size, seed=0):
+        lengths = np.diff(pairs.offsets)
+        self.input_lengths = lengths[0::2]
+        self.target_lengths = lengths[1::2]
+        self.batch_size = batch_size
+        self.seed = seed
+        self.batches_per_epoch = len(pairs) // batch_size
+        if self.batches_per_epoch == 0:
+            raise ValueError(len(pairs), "pairs are not enough for a batch of size", batch_size)
+
+    # 返回第epoch个epoch的所有batch，shape是(batches_per_epoch, batch_size)
+    def epochBatches(self, epoch):
+        rng = np.random.RandomState(self.seed + epoch)
+        order = rng.permutation(len(self.input_lengths))
+        # lexsort是稳定的，最后一个key是主key
+        order = order[np.lexsort((self.target_lengths[order], self.input_lengths[order]))]
+        # 句对的个数一般不是batch_size的整数倍，随机的从某个位置开始取，这样每个epoch丢掉的句对不一样
+        n = self.batches_per_epoch * self.batch_size
+        start = rng.randint(len(order) - n + 1)
+        batches = order[start:start + n].reshape(self.batches_per_epoch, self.batch_size)
+        return batches[rng.permutation(self.batches_per_epoch)]
+
+    # 从第start个batch开始返回，只需要生成start所在的那个epoch
+    def batches(self, start=0):
+        epoch, offset = divmod(start, self.batches_per_epoch)
+        while True:
+            for batch in self.epochBatches(epoch)[offset:]:
+                yield batch
+            epoch += 1
+            offset = 0
+
+    def __iter__(self):
+        return self.batches()
+
+
+# 用n_workers个后台线程调用batch_fn(indices)构造batch，最多提前构造prefetch个，返回的顺序和index_batches一样。
+# 如果pin_memory为True，那么把batch里的Tensor放到pinned memory里，这样复制到GPU会更快。
+def prefetchBatches(batch_fn, index_batches, n_workers=2, prefetch=8, pin_memory=False):
+    def build(indices):
+        batch = batch_fn(indices)
+        if pin_memory:
+            batch = tuple(x.pin_memory() if torch.is_tensor(x) else x for x in batch)
+        return batch
+
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+        futures = collections.deque()
+        for indices in index_batches:
+            futures.append(executor.submit(build, indices))
+            if len(futures) >= prefetch:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+# PAD占所有位置的比例，包括问题和答案(都要加上EOS)
+def paddingRatio(pairs, batches):
+    lengths = np.diff(pairs.offsets) + 1
+    total = padded = 0
+    for batch in batches:
+        for batch_lengths in (lengths[2 * batch], lengths[2 * batch + 1]):
+            total += batch_lengths.max() * len(batch)
+            padded += batch_lengths.max() * len(batch) - batch_lengths.sum()
+    return padded / total
+
+
 # ## 定义模型
 # 
 # 
@@ -668,6 +1044,13 @@ class EncoderRNN(nn.Module):
 # In[11]:
 
 
+# 根据输入的长度构造mask，shape是(max_len, batch)，padding的位置是False。
+# 一个batch里短的句子在pad_packed_sequence之后会补零，这些位置不应该分配注意力。
+def sourceMask(lengths, max_len, device=None):
+    lengths = lengths.to(device)
+    return torch.arange(max_len, device=device).unsqueeze(1) < lengths.unsqueeze(0)
+
+
 # Luong 注意力layer
 class Attn(torch.nn.Module):
     def __init__(self, method, hidden_size):
@@ -682,40 +1065,63 @@ class Attn(torch.nn.Module):
             self.attn = torch.nn.Linear(self.hidden_size * 2, hidden_size)
             self.v = torch.nn.Parameter(torch.FloatTensor(hidden_size))
 
+    # 注意力的score里只和encoder的输出有关的部分(我们叫它keys)，对于同一个输入，decoder的每个时刻都是一样的，
+    # 因此可以在encoder计算完成之后预先计算一次，decoder的每个时刻只需要计算和隐状态hidden有关的部分。
+    # dot: keys就是encoder_outputs
+    # general: keys是self.attn(encoder_outputs)
+    # concat: self.attn的矩阵W可以分成两半[W_h, W_e]，W[h;e]+b = W_h*h + (W_e*e+b)，keys是W_e*e+b
+    # 这样每个时刻的计算量从O(input_lengths x hidden_size^2)变成了O(input_lengths x hidden_size)。
+    def precompute(self, encoder_outputs):
+        if self.method == 'general':
+            return self.attn(encoder_outputs)
+        elif self.method == 'concat':
+            return F.linear(encoder_outputs, self.attn.weight[:, self.hidden_size:], self.attn.bias)
+        return encoder_outputs
+
+    # concat方法里和hidden有关的部分W_h*h
+    def concat_query(self, hidden):
+        return F.linear(hidden, self.attn.weight[:, :self.hidden_size])
+
+    # dot_score用来说明内积的计算方法，forward实际使用的是下面score函数里等价的bmm。
     def dot_score(self, hidden, encoder_output):
         # 输入hidden的shape是(1, batch=64, hidden_size=500)
         # encoder_outputs的shape是(input_lengths=10, batch=64, hidden_size=500)
         # hidden * encoder_output得到的shape是(10, 64, 500)，然后对第3维求和就可以计算出score。
         return torch.sum(hidden * encoder_output, dim=2)
 
-    def general_score(self, hidden, encoder_output):
-        energy = self.attn(encoder_output)
-        return torch.sum(hidden * energy, dim=2)
+    # 计算注意力的score，hidden的shape是(T, batch, hidden_size)，keys是(input_lengths, batch, hidden_size)
+    # 返回的shape是(batch, T, input_lengths)
+    def score(self, hidden, keys):
+        if self.method == 'concat':
+            # W_h*h是(T, batch, hidden_size)，通过broadcasting和keys相加得到(T, input_lengths, batch, hidden_size)
+            energy = (self.concat_query(hidden).unsqueeze(1) + keys.unsqueeze(0)).tanh()
+            # (T, input_lengths, batch) -> (batch, T, input_lengths)
+            return torch.sum(self.v * energy, dim=3).permute(2, 0, 1)
+        # dot和general都是内积，用bmm计算，结果和dot_score一样，但是不需要生成(10, 64, 500)的中间结果。
+        # (batch, T, hidden_size) x (batch, hidden_size, input_lengths) -> (batch, T, input_lengths)
+        return torch.bmm(hidden.transpose(0, 1), keys.permute(1, 2, 0))
 
-    def concat_score(self, hidden, encoder_output):
-        energy = self.attn(torch.cat((hidden.expand(encoder_output.size(0), -1, -1), encoder_output), 2)).tanh()
-        return torch.sum(self.v * energy, dim=2)
-    
     # 输入是上一个时刻的隐状态hidden和所有时刻的Encoder的输出encoder_outputs
-    # 输出是注意力的概率，也就是长度为input_lengths的向量，它的和加起来是1。
-    def forward(self, hidden, encoder_outputs):
-        # 计算注意力的score，输入hidden的shape是(1, batch=64, hidden_size=500),表示t时刻batch数据的隐状态
-        # encoder_outputs的shape是(input_lengths=10, batch=64, hidden_size=500) 
-        if self.method == 'general':
-            attn_energies = self.general_score(hidden, encoder_outputs)
-        elif self.method == 'concat':
-            attn_energies = self.concat_score(hidden, encoder_outputs)
-        elif self.method == 'dot':
-            # 计算内积，参考dot_score函数
-            attn_energies = self.dot_score(hidden, encoder_outputs)
-
-        # Transpose max_length and batch_size dimensions
-        # 把attn_energies从(max_length=10, batch=64)转置成(64, 10)
-        attn_energies = attn_energies.t()
-
-        # 使用softmax函数把score变成概率，shape仍然是(64, 10)，然后用unsqueeze(1)变成
-        # (64, 1, 10) 
-        return F.softmax(attn_energies, dim=1).unsqueeze(1)
+    # 输出是注意力的概率，shape是(64, 1, 10)，最后一维的和加起来是1。
+    # keys是precompute(encoder_outputs)的结果，如果是None，那么在这里计算
+    # mask是sourceMask的结果，shape是(input_lengths, batch)，如果是None表示没有padding
+    def forward(self, hidden, encoder_outputs, keys=None, mask=None):
+        # 输入hidden的shape是(1, batch=64, hidden_size=500),表示t时刻batch数据的隐状态，
+        # 因此它就是下面的sequence在T=1时的特例
+        return self.sequence(hidden, encoder_outputs, keys, mask)
+
+    # 一次计算所有时刻的注意力，hidden的shape是(T, batch, hidden_size)，表示decoder T个时刻的输出
+    # encoder_outputs的shape是(input_lengths, batch, hidden_size)
+    # 返回的注意力概率的shape是(batch, T, input_lengths)
+    def sequence(self, hidden, encoder_outputs, keys=None, mask=None):
+        if keys is None:
+            keys = self.precompute(encoder_outputs)
+        attn_energies = self.score(hidden, keys)
+        if mask is not None:
+            # padding的位置的score是-inf，softmax之后的概率就是0
+            attn_energies = attn_energies.masked_fill(~mask.t().unsqueeze(1), float('-inf'))
+        # 使用softmax函数把score变成概率
+        return F.softmax(attn_energies, dim=2)
 
 
 # 上面的代码实现了dot、general和concat三种score计算方法，分别和前面的三个公式对应，我们这里介绍最简单的dot方法。
@@ -788,8 +1194,9 @@ class Attn(torch.nn.Module):
 # In[12]:
 
 
+# counts不是None的时候，输出层使用AdaptiveSoftmaxHead(参考后面的Adaptive Softmax)，counts是每个词的词频(targetCounts的结果)
 class LuongAttnDecoderRNN(nn.Module):
-    def __init__(self, attn_model, embedding, hidden_size, output_size, n_layers=1, dropout=0.1):
+    def __init__(self, attn_model, embedding, hidden_size, output_size, n_layers=1, dropout=0.1, counts=None):
         super(LuongAttnDecoderRNN, self).__init__()
 
         # 保存到self里，attn_model就是前面定义的Attn类的对象。
@@ -804,11 +1211,22 @@ class LuongAttnDecoderRNN(nn.Module):
         self.embedding_dropout = nn.Dropout(dropout)
         self.gru = nn.GRU(hidden_size, hidden_size, n_layers, dropout=(0 if n_layers == 1 else dropout))
         self.concat = nn.Linear(hidden_size * 2, hidden_size)
-        self.out = nn.Linear(hidden_size, output_size)
+        if counts is None:
+            self.out = nn.Linear(hidden_size, output_size)
+        else:
+            self.out = AdaptiveSoftmaxHead(hidden_size, counts)
 
         self.attn = Attn(attn_model, hidden_size)
 
-    def forward(self, input_step, last_hidden, encoder_outputs):
+    # 预先计算注意力的keys，参考Attn.precompute
+    def precompute(self, encoder_outputs):
+        return self.attn.precompute(encoder_outputs)
+
+    # 如果return_logits为True，那么返回softmax之前的logits，训练的时候用来计算交叉熵。
+    # encoder_keys是precompute(encoder_outputs)的结果，同一个输入的每个时刻都可以复用它。
+    # encoder_mask是sourceMask的结果，batch里的句子长度不同的时候用来去掉padding位置的注意力。
+    def forward(self, input_step, last_hidden, encoder_outputs, return_logits=False, encoder_keys=None,
+                encoder_mask=None):
         # 注意：decoder每一步只能处理一个时刻的数据，因为t时刻计算完了才能计算t+1时刻。
         # input_step的shape是(1, 64)，64是batch，1是当前输入的词ID(来自上一个时刻的输出)
         # 通过embedding层变成(1, 64, 500)，然后进行dropout，shape不变。
@@ -819,7 +1237,7 @@ class LuongAttnDecoderRNN(nn.Module):
         # hidden是(2, 64, 500)，因为是双向的GRU，所以第一维是2。
         rnn_output, hidden = self.gru(embedded, last_hidden)
         # 计算注意力权重， 根据前面的分析，attn_weights的shape是(64, 1, 10)
-        attn_weights = self.attn(rnn_output, encoder_outputs)
+        attn_weights = self.attn(rnn_output, encoder_outputs, encoder_keys, encoder_mask)
         
         # encoder_outputs是(10, 64, 500) 
         # encoder_outputs.transpose(0, 1)后的shape是(64, 10, 500)
@@ -843,11 +1261,102 @@ class LuongAttnDecoderRNN(nn.Module):
 
         # out是(500, 词典大小=7826)    
         output = self.out(concat_output)
+        if return_logits:
+            return output, hidden
         # 用softmax变成概率，表示当前时刻输出每个词的概率。
         output = F.softmax(output, dim=1)
         # 返回 output和新的隐状态 
         return output, hidden
 
+    # teacher forcing的时候，每个时刻的输入都是已知的(SOS和正确答案)，而注意力是在GRU之后计算的，
+    # 因此可以把整个序列一次传给GRU，然后用bmm一次计算所有时刻的注意力，而不需要一个时刻一个时刻的循环。
+    # input_seq的shape是(T, batch)，返回所有时刻的logits，shape是(T, batch, 词典大小)，以及最后时刻的隐状态。
+    # 如果return_features为True，那么返回out层之前的特征(T, batch, hidden_size)，sampled softmax用它计算部分词的得分。
+    def forwardSequence(self, input_seq, last_hidden, encoder_outputs, encoder_keys=None, encoder_mask=None,
+                        return_features=False):
+        embedded = self.embedding(input_seq)
+        embedded = self.embedding_dropout(embedded)
+        # rnn_output是(T, 64, 500)
+        rnn_output, hidden = self.gru(embedded, last_hidden)
+        # attn_weights是(64, T, 10)，context是(64, T, 500)
+        attn_weights = self.attn.sequence(rnn_output, encoder_outputs, encoder_keys, encoder_mask)
+        context = attn_weights.bmm(encoder_outputs.transpose(0, 1))
+        # 拼接得到(T, 64, 1000)
+        concat_input = torch.cat((rnn_output, context.transpose(0, 1)), 2)
+        concat_output = torch.tanh(self.concat(concat_input))
+        if return_features:
+            return concat_output, hidden
+        return self.out(concat_output), hidden
+
+
+# ### Adaptive Softmax
+# 
+# 聊天数据的词频大致符合Zipf分布：少数的常见词占了大部分的输出，而大部分的词都很少出现。
+# [Adaptive softmax](https://arxiv.org/abs/1609.04309)根据词频把词典分成几个cluster：最常见的词(head)使用完整的hidden_size维的输出层，
+# 其余的词按照词频分成几个tail cluster，每个cluster先用一个矩阵把特征投影到更低的维度(每个cluster的维度除以div_value)，然后再计算cluster里每个词的得分。
+# head除了常见的词之外还有每个tail cluster的得分，一个词的概率是它所在的cluster的概率乘以它在cluster里的概率。
+# 
+# PyTorch提供了``nn.AdaptiveLogSoftmaxWithLoss``，它要求词的ID是按照词频从高到低排列的，而我们的词ID是按照出现的顺序分配的。
+# 为了不改变词典和预处理的缓存，``AdaptiveSoftmaxHead``在内部记录词ID和词频排名的对应关系：
+# 
+# - 训练的时候(``maskedLoss``)只计算每个正确的词所在的cluster，大部分的词都在head里，因此计算量比完整的输出层少很多。
+# - 预测的时候(forward)返回所有词的log概率(按照词ID的顺序)，decoder把它当成logits返回，因为log概率的softmax就是概率本身，所以贪心解码、beam search和``maskedCrossEntropy``都不需要修改。tail cluster的维度较低，因此也比完整的输出层快。
+# 
+# cluster的边界(cutoffs)由词频决定：按照词频从高到低排序之后，head包含累计占所有词80%的词，第二个cluster到95%，剩下的词是最后一个cluster。
+# EOS在每个回复的最后都会出现，但是它不在``Voc.counts``里，``targetCounts``把它的词频设置成最常见的词的词频，这样它总是在head里。
+# 
+# 
+
+# In[ ]:
+
+
+# 作为decoder输出的每个词的词频：EOS的词频设置成最常见的词的词频，PAD和SOS是0
+def targetCounts(voc):
+    counts = voc.counts[:voc.num_words].astype(np.float64)
+    counts[EOS_token] = counts.max()
+    counts[PAD_token] = 0
+    counts[SOS_token] = 0
+    return counts
+
+
+# 根据词频计算adaptive softmax的cutoffs，coverage是前几个cluster累计覆盖的词频的比例
+def adaptiveCutoffs(counts, coverage=(0.8, 0.95)):
+    cumulative = np.cumsum(np.sort(counts)[::-1]) / max(counts.sum(), 1)
+    cutoffs = []
+    for c in coverage:
+        cutoff = int(np.searchsorted(cumulative, c)) + 1
+        if (not cutoffs or cutoff > cutoffs[-1]) and cutoff < len(counts) - 1:
+            cutoffs.append(cutoff)
+    if not cutoffs:
+        raise ValueError(len(counts), "is not an appropriate vocabulary size for adaptive softmax.")
+    return cutoffs
+
+
+class AdaptiveSoftmaxHead(nn.Module):
+    def __init__(self, hidden_size, counts, cutoffs=None, div_value=4.0):
+        super(AdaptiveSoftmaxHead, self).__init__()
+        counts = np.asarray(counts)
+        if cutoffs is None:
+            cutoffs = adaptiveCutoffs(counts)
+        # order[排名]是词ID，rank[词ID]是按词频从高到低的排名
+        order = np.argsort(-counts, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.register_buffer('rank', torch.from_numpy(rank).long())
+        self.softmax = nn.AdaptiveLogSoftmaxWithLoss(hidden_size, len(counts), cutoffs, div_value)
+
+    # input是(..., hidden_size)，返回(..., 词典大小)的log概率，最后一维是词ID的顺序
+    def forward(self, input):
+        log_probs = self.softmax.log_prob(input.reshape(-1, input.size(-1)))
+        return log_probs.index_select(1, self.rank).view(*input.shape[:-1], -1)
+
+    # features是(T, B, hidden_size)，target和mask是(T, B)，返回值和maskedCrossEntropy一样
+    def maskedLoss(self, features, target, mask, nTotals=None):
+        # padding位置的loss不需要，把它们的目标换成EOS，这样就不用计算PAD所在的tail cluster
+        target = target.masked_fill(~mask, EOS_token)
+        output = self.softmax(features.reshape(-1, features.size(-1)), self.rank[target.reshape(-1)]).output
+        return maskedMean(-output.view(target.size()), mask, nTotals)
+
 
 # ## 定义训练过程
 # 
@@ -926,8 +1435,90 @@ def maskNLLLoss(inp, target, mask):
 #         [ 0.3000]])
 # ```
 # 
+# ### 对整个序列计算Masked损失
+# 
+# ``maskNLLLoss``每个时刻都要调用一次，每次调用``nTotal.item()``和``train``里的``mask_loss.item()``都需要等待GPU计算完成(同步)，
+# 而且先softmax再求log在概率很小的时候数值不稳定，所有时刻的概率tensor也都要保存下来用于反向计算。
+# 因此训练的时候我们让decoder直接返回logits(softmax之前的值)，把所有时刻的logits拼成一个(T, B, V)的tensor，
+# 然后用``F.cross_entropy``(也就是log_softmax加上NLLLoss)一次计算所有时刻的交叉熵，最后用mask去掉padding的部分。
+# 
+# 为了和原来的训练过程一样，loss仍然是每个时刻对非padding的词求平均，然后把所有时刻的平均值加起来。
+# 另外返回的平均loss(用于输出)是一个tensor，``train``在每个batch结束时才调用一次``.item()``。
+# 
+# 
+
+# In[ ]:
+
+
+# logits的shape是(T, B, V)，target和mask的shape是(T, B)
+# 返回用于反向计算的loss，以及所有非padding的词的平均交叉熵(用于输出)
+# nTotals参考maskedMean
+def maskedCrossEntropy(logits, target, mask, nTotals=None):
+    T, B, V = logits.size()
+    crossEntropy = F.cross_entropy(logits.reshape(T * B, V).float(), target.reshape(T * B),
+                                   reduction='none').view(T, B)
+    return maskedMean(crossEntropy, mask, nTotals)
+
+
+# crossEntropy是(T, B)的每个词的loss，去掉padding的位置之后计算maskedCrossEntropy的两个返回值
+# nTotals是每个时刻非padding的词的个数，如果是None，那么用mask计算。梯度累积的时候它是整个batch(所有micro-batch)的词数，
+# 这样每个micro-batch的loss加起来就等于整个batch的loss。
+def maskedMean(crossEntropy, mask, nTotals=None):
+    crossEntropy = crossEntropy.float().masked_fill(~mask, 0)
+    if nTotals is None:
+        nTotals = mask.sum(dim=1)
+    loss = (crossEntropy.sum(dim=1) / nTotals[:crossEntropy.size(0)].clamp(min=1)).sum()
+    return loss, crossEntropy.detach().sum() / nTotals.sum()
+
+
+# ### Sampled Softmax
+# 
+# decoder的输出层``out``是一个(hidden_size, 词典大小)的全连接层，每个时刻都要计算所有词的得分然后进行softmax。
+# 如果用自己的数据训练，trimRareWords之后还有10万以上的词，那么大部分的计算量和显存都花在这一层上。
+# [Sampled softmax](https://arxiv.org/abs/1412.2007)在训练的时候只计算正确的词和随机采样的num_sampled个负样本(其它的词)的得分，然后在这num_sampled+1个词上计算交叉熵：
+# 
+# - 负样本从unigram分布的power(0.75)次方里采样，也就是Voc.counts决定的词频(``targetCounts``)，这样常见的词更容易被采样到。PAD和SOS不会被采样。
+# - 一个batch里所有的词共享同一组负样本，因此负样本的得分可以用一个矩阵乘法计算。
+# - 因为负样本不是均匀采样的，每个词的得分要减去log(它在num_sampled次采样里出现的期望次数)，也就是logQ修正，这样sampled softmax的梯度才是full softmax梯度的(近似)无偏估计。
+# - 如果某个负样本正好是这个位置的正确的词(accidental hit)，那么把它的得分设置成-inf，不让它作为负样本。
+# 
+# sampled softmax只用于teacher forcing的训练：decoder用``forwardSequence(..., return_features=True)``返回``out``层之前的特征，然后只计算需要的那些词的得分。
+# 不使用teacher forcing的时候，下一个时刻的输入是所有词里得分最高的词，因此仍然需要计算完整的输出，这时使用普通的交叉熵。预测的时候也仍然使用完整的softmax。
+# 注意：sampled softmax的loss只在num_sampled+1个词上计算，因此它比完整的交叉熵要小，这两个值不能直接比较。
+# sampled softmax需要``out``的参数矩阵，因此不能和adaptive softmax一起使用。
 # 
 # 
+
+# In[ ]:
+
+
+class SampledSoftmaxLoss:
+    def __init__(self, voc, num_sampled=1024, power=0.75):
+        probs = targetCounts(voc) ** power
+        probs /= probs.sum()
+        self.num_sampled = num_sampled
+        self.probs = torch.tensor(probs, dtype=torch.float, device=device)
+        # 有放回的采样num_sampled次，每个词出现的期望次数是num_sampled * q，PAD和SOS的概率是0，log的时候避免-inf
+        self.log_expected = torch.log((self.probs * num_sampled).clamp(min=1e-20))
+
+    # features是(T, B, hidden_size)的decoder特征，out是decoder.out，target和mask是(T, B)
+    # 返回值和maskedCrossEntropy一样
+    def __call__(self, features, out, target, mask, nTotals=None):
+        T, B, H = features.size()
+        features = features.reshape(T * B, H)
+        target = target.reshape(T * B)
+        samples = torch.multinomial(self.probs, self.num_sampled, replacement=True)
+        # 正确的词的得分，(T*B,)
+        true_logits = (features * out.weight[target]).sum(dim=1) + out.bias[target] - self.log_expected[target]
+        # 负样本的得分，(T*B, num_sampled)
+        sampled_logits = F.linear(features, out.weight[samples], out.bias[samples]) - self.log_expected[samples]
+        sampled_logits = sampled_logits.masked_fill(samples.unsqueeze(0) == target.unsqueeze(1), float('-inf'))
+        # 正确的词在第0个位置，交叉熵是logsumexp减去正确的词的得分
+        logits = torch.cat((true_logits.unsqueeze(1), sampled_logits), dim=1)
+        crossEntropy = (torch.logsumexp(logits.float(), dim=1) - true_logits.float()).view(T, B)
+        return maskedMean(crossEntropy, mask, nTotals)
+
+
 # ### 一次迭代的训练过程
 # 
 # 
@@ -947,8 +1538,8 @@ def maskNLLLoss(inp, target, mask):
 # 
 #    1) 把整个batch的输入传入encoder 
 #    2) 把decoder的输入设置为特殊的<SOS>，初始隐状态设置为encoder最后时刻的隐状态
-#    3) decoder每次处理一个时刻的forward计算 
-#    4) 如果是teacher forcing，把上个时刻的"正确的"词作为当前输入，否则用上一个时刻的输出作为当前时刻的输入
+#    3) 如果是teacher forcing，把上个时刻的"正确的"词作为当前输入，这样所有时刻的输入都是已知的，decoder一次处理整个序列
+#    4) 否则decoder每次处理一个时刻的forward计算，用上一个时刻的输出作为当前时刻的输入
 #    5) 计算loss
 #    6) 反向计算梯度 
 #    7) 对梯度进行裁剪
@@ -965,26 +1556,80 @@ def maskNLLLoss(inp, target, mask):
 # In[14]:
 
 
+# forcing_ratio如果是None，那么使用全局的teacher_forcing_ratio。
+# 如果scheduled_sampling为False，那么整个batch以forcing_ratio的概率使用teacher forcing；
+# 否则每个时刻每个句子都以forcing_ratio的概率使用正确答案，否则使用模型的预测作为下一个时刻的输入。
 def train(input_variable, lengths, target_variable, mask, max_target_len, encoder, decoder, embedding,
-          encoder_optimizer, decoder_optimizer, batch_size, clip, max_length=MAX_LENGTH):
+          encoder_optimizer, decoder_optimizer, batch_size, clip, max_length=MAX_LENGTH,
+          forcing_ratio=None, scheduled_sampling=False, sampled_softmax=None, distributed=False,
+          micro_batches=(), autocast=False):
 
     # 梯度清空
     encoder_optimizer.zero_grad()
     decoder_optimizer.zero_grad()
 
+    if forcing_ratio is None:
+        forcing_ratio = teacher_forcing_ratio
+
+    # 确定是否teacher forcing，scheduled sampling的概率是1的时候也相当于teacher forcing
+    if scheduled_sampling:
+        use_teacher_forcing = forcing_ratio >= 1
+        scheduled_sampling = forcing_ratio > 0
+    else:
+        use_teacher_forcing = True if random.random() < forcing_ratio else False
+
+    # 梯度累积：micro_batches是同一次更新的其它micro-batch，每个都是(input_variable, lengths, target_variable, mask, max_target_len)
+    batches = [(input_variable, lengths, target_variable, mask, max_target_len)] + list(micro_batches)
+    # 整个batch每个时刻非padding的词数，用它作为每个micro-batch的loss的分母
+    nTotals = torch.zeros(max(batch[4] for batch in batches), dtype=torch.long, device=device)
+    for batch in batches:
+        nTotals[:batch[4]] += batch[3][:batch[4]].to(device, non_blocking=True).sum(dim=1)
+
+    print_loss = 0
+    for batch in batches:
+        # bf16 autocast：forward和loss使用bfloat16计算，参数和优化器的状态仍然是fp32
+        with torch.autocast(device.type, dtype=torch.bfloat16, enabled=autocast):
+            loss, batch_print_loss = batchLoss(*batch, encoder, decoder, use_teacher_forcing, scheduled_sampling,
+                                               forcing_ratio, sampled_softmax, nTotals)
+        # 反向计算，梯度会累加到参数的grad里
+        loss.backward()
+        print_loss += batch_print_loss
+
+    # 数据并行训练的时候，所有worker的梯度求平均之后再裁剪和更新，这样所有worker的参数总是一样的
+    if distributed:
+        allreduceGradients(encoder, decoder)
+
+    # 对encoder和decoder进行梯度裁剪
+    _ = torch.nn.utils.clip_grad_norm_(encoder.parameters(), clip)
+    _ = torch.nn.utils.clip_grad_norm_(decoder.parameters(), clip)
+
+    # 更新参数
+    encoder_optimizer.step()
+    decoder_optimizer.step()
+
+    # 每个batch只读取一次loss的值
+    return print_loss.item()
+
+
+# 一个(micro-)batch的forward计算，返回用于反向计算的loss和用于输出的平均loss，参数nTotals参考maskedMean
+def batchLoss(input_variable, lengths, target_variable, mask, max_target_len, encoder, decoder,
+              use_teacher_forcing, scheduled_sampling, forcing_ratio, sampled_softmax, nTotals):
+    batch_size = input_variable.size(1)
+
     # 设置device，从而支持GPU，当然如果没有GPU也能工作。
-    input_variable = input_variable.to(device)
-    lengths = lengths.to(device)
-    target_variable = target_variable.to(device)
-    mask = mask.to(device)
+    # prefetchBatches把batch放到了pinned memory里，non_blocking的复制可以和计算重叠
+    # pack_padded_sequence要求lengths在CPU上，sourceMask会把它复制到device上
+    input_variable = input_variable.to(device, non_blocking=True)
+    target_variable = target_variable.to(device, non_blocking=True)
+    mask = mask.to(device, non_blocking=True)
 
-    # 初始化变量
-    loss = 0
-    print_losses = []
-    n_totals = 0
+    # 保存每个时刻decoder输出的logits
+    decoder_outputs = []
 
     # encoder的Forward计算
     encoder_outputs, encoder_hidden = encoder(input_variable, lengths)
+    # batch里短的句子padding的位置不计算注意力
+    encoder_mask = sourceMask(lengths, encoder_outputs.size(0), device)
 
     # Decoder的初始输入是SOS，我们需要构造(1, batch)的输入，表示第一个时刻batch个输入。
     decoder_input = torch.LongTensor([[SOS_token for _ in range(batch_size)]])
@@ -993,49 +1638,238 @@ def train(input_variable, lengths, target_variable, mask, max_target_len, encode
     # 注意：Encoder是双向的，而Decoder是单向的，因此从下往上取n_layers个
     decoder_hidden = encoder_hidden[:decoder.n_layers]
 
-    # 确定是否teacher forcing
-    use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
+    # adaptive softmax和sampled softmax在teacher forcing的时候使用out层之前的特征计算loss
+    adaptive = isinstance(decoder.out, AdaptiveSoftmaxHead)
+    use_features = use_teacher_forcing and (adaptive or sampled_softmax is not None)
 
-    # 一次处理一个时刻 
     if use_teacher_forcing:
-        for t in range(max_target_len):
-            decoder_output, decoder_hidden = decoder(
-                decoder_input, decoder_hidden, encoder_outputs
-            )
-            # Teacher forcing: 下一个时刻的输入是当前正确答案
-            decoder_input = target_variable[t].view(1, -1)
-            # 计算累计的loss
-            mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable[t], mask[t])
-            loss += mask_loss
-            print_losses.append(mask_loss.item() * nTotal)
-            n_totals += nTotal
+        # Teacher forcing: 每个时刻的输入是上一个时刻的正确答案，第一个时刻是SOS
+        # 所有时刻的输入都是已知的，因此一次计算整个序列
+        decoder_inputs = torch.cat((decoder_input, target_variable[:max_target_len - 1]), 0)
+        decoder_outputs, decoder_hidden = decoder.forwardSequence(
+            decoder_inputs, decoder_hidden, encoder_outputs, encoder_mask=encoder_mask,
+            return_features=use_features
+        )
     else:
+        # 注意力的keys对每个时刻都是一样的，只计算一次
+        encoder_keys = decoder.precompute(encoder_outputs)
+        # 一次处理一个时刻 
         for t in range(max_target_len):
             decoder_output, decoder_hidden = decoder(
-                decoder_input, decoder_hidden, encoder_outputs
+                decoder_input, decoder_hidden, encoder_outputs, return_logits=True,
+                encoder_keys=encoder_keys, encoder_mask=encoder_mask
             )
             # 不是teacher forcing: 下一个时刻的输入是当前模型预测概率最高的值
-            _, topi = decoder_output.topk(1)
-            decoder_input = torch.LongTensor([[topi[i][0] for i in range(batch_size)]])
-            decoder_input = decoder_input.to(device)
-            # 计算累计的loss
-            mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable[t], mask[t])
-            loss += mask_loss
-            print_losses.append(mask_loss.item() * nTotal)
-            n_totals += nTotal
-
-    # 反向计算 
-    loss.backward()
+            # 直接在device上计算argmax，不需要把结果复制到CPU。
+            decoder_input = decoder_output.argmax(dim=1)
+            if scheduled_sampling:
+                # 每个句子以forcing_ratio的概率使用正确答案
+                use_target = torch.rand(batch_size, device=device) < forcing_ratio
+                decoder_input = torch.where(use_target, target_variable[t], decoder_input)
+            decoder_input = decoder_input.view(1, -1)
+            decoder_outputs.append(decoder_output)
+        decoder_outputs = torch.stack(decoder_outputs)
 
-    # 对encoder和decoder进行梯度裁剪
-    _ = torch.nn.utils.clip_grad_norm_(encoder.parameters(), clip)
-    _ = torch.nn.utils.clip_grad_norm_(decoder.parameters(), clip)
+    # 所有时刻一起计算loss，use_features的时候decoder_outputs是out层之前的特征
+    target_variable = target_variable[:max_target_len]
+    mask = mask[:max_target_len]
+    if use_features and adaptive:
+        return decoder.out.maskedLoss(decoder_outputs, target_variable, mask, nTotals)
+    elif use_features:
+        return sampled_softmax(decoder_outputs, decoder.out, target_variable, mask, nTotals)
+    return maskedCrossEntropy(decoder_outputs, target_variable, mask, nTotals)
 
-    # 更新参数
-    encoder_optimizer.step()
-    decoder_optimizer.step()
 
-    return sum(print_losses) / n_totals
+# ### Scheduled Sampling
+# 
+# teacher forcing训练的时候decoder每个时刻的输入都是正确答案，但是测试的时候输入是模型自己的预测，这两者的差异会导致错误的累积。
+# Bengio等人在[论文](https://arxiv.org/abs/1506.03099)里提出了scheduled sampling：每个时刻每个句子都以概率$\epsilon_i$使用正确答案，
+# 否则使用模型的预测，而$\epsilon_i$随着训练的迭代次数i逐渐减小，也就是一开始主要使用teacher forcing，后面逐渐变成使用模型的预测。
+# 论文里介绍了三种衰减的方法：
+# 
+# - linear: $\epsilon_i = \max(\epsilon_{min}, 1 - i/k)$
+# - exponential: $\epsilon_i = k^i$，其中$k < 1$
+# - inverse_sigmoid: $\epsilon_i = k/(k+\exp(i/k))$，其中$k \ge 1$
+# 
+# 三种方法的k的含义和范围都不一样，``checkSamplingSchedule``检查k是否在范围内，``DEFAULT_SAMPLING_DECAY``是每种方法的默认值。
+# 在``train``里，选择正确答案还是模型的预测是用``torch.where``对整个batch一次完成的，所有的数据都在device上。
+# 
+# 
+
+# In[ ]:
+
+
+# 每种衰减方法的参数k的默认值
+DEFAULT_SAMPLING_DECAY = {'linear': 1000.0, 'exponential': 0.999, 'inverse_sigmoid': 100.0}
+
+
+# 检查k是否适合schedule：linear要求k > 0，exponential要求0 < k < 1，inverse_sigmoid要求k >= 1
+def checkSamplingSchedule(schedule, k):
+    if schedule not in DEFAULT_SAMPLING_DECAY:
+        raise ValueError(schedule, "is not an appropriate sampling schedule.")
+    if k is None or (schedule == 'linear' and not k > 0) or (schedule == 'exponential' and not 0 < k < 1) \
+            or (schedule == 'inverse_sigmoid' and not k >= 1):
+        raise ValueError(k, "is not an appropriate sampling decay for the {} schedule.".format(schedule))
+
+
+def teacherForcingSchedule(iteration, schedule, k, min_ratio=0.0):
+    checkSamplingSchedule(schedule, k)
+    if schedule == 'linear':
+        ratio = 1.0 - iteration / k
+    elif schedule == 'exponential':
+        ratio = k ** iteration
+    else:
+        # exp的参数太大会溢出
+        ratio = k / (k + math.exp(min(iteration / k, 700)))
+    return max(min_ratio, ratio)
+
+
+# ### 异步保存checkpoint
+# 
+# 原来的``trainIters``直接调用``torch.save``，保存的时候训练要停下来，而且每个checkpoint都包含了整个词典。现在保存checkpoint分成两步：
+# 
+# - 在训练的线程里用``cpuSnapshot``把模型和优化器的state_dict复制到CPU上(只是内存复制，很快)，之后训练可以继续修改参数。
+# - ``CheckpointWriter``用一个后台线程把复制的结果写到文件里，先写到一个临时文件然后再改名，因此即使中途退出也不会留下不完整的checkpoint。
+# 如果上一个checkpoint还没有写完，那么先等它写完，这样最多只有一份复制的state_dict。
+# 
+# 词典在一次训练里是不变的，因此它只在第一次保存的时候写到同一个目录下的voc.bin，checkpoint里只记录它的sha1。``loadCheckpoint``加载checkpoint的时候会检查voc.bin的sha1，
+# 以前的checkpoint里仍然有'voc'，原来的教程保存的checkpoint里是'voc_dict'(voc.__dict__)，它们也可以加载。
+# 
+# 为了能够从checkpoint准确的继续训练，checkpoint里还保存了Python、numpy和torch的随机数生成器的状态(数据并行训练的时候是每个worker的状态)，以及sampler已经使用了多少个batch。
+# 采样器的第i个batch只由随机种子和i决定，因此恢复训练的时候从这个位置继续采样，加上随机数的状态，得到的batch和teacher forcing、dropout的随机选择都和没有中断一样。
+# 
+# 目录下的checkpoints.json记录了所有checkpoint的迭代次数和平均loss(从上一次保存到这一次的平均loss)，``CheckpointWriter``只保留最近的keep_last个和loss最小的那个，其它的会被删除。
+# 
+# 
+
+# In[ ]:
+
+
+# 把state_dict(可以是嵌套的dict和list)里的tensor复制到CPU上
+def cpuSnapshot(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: cpuSnapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpuSnapshot(value) for value in state)
+    return state
+
+
+# 随机数生成器的状态
+def rngState():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if USE_CUDA:
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def setRngState(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if USE_CUDA and 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# 加载checkpoint，checkpoint['voc']是Voc对象。新的checkpoint的词典在同一个目录的voc.bin里，
+# 以前的checkpoint的词典在'voc'里，原来的教程保存的checkpoint的词典在'voc_dict'里
+def loadCheckpoint(filename, map_location=None):
+    checkpoint = torch.load(filename, map_location=map_location, weights_only=False)
+    if 'voc_dict' in checkpoint:
+        checkpoint['voc'] = Voc.fromDict(checkpoint['voc_dict'])
+    elif 'voc' in checkpoint:
+        checkpoint['voc'] = Voc.fromBytes(checkpoint['voc'])
+    else:
+        with open(os.path.join(os.path.dirname(filename), 'voc.bin'), 'rb') as f:
+            data = f.read()
+        if hashlib.sha1(data).hexdigest() != checkpoint['voc_sha1']:
+            raise ValueError(filename, "does not match the vocabulary in voc.bin")
+        checkpoint['voc'] = Voc.fromBytes(data)
+    return checkpoint
+
+
+# 在后台线程里保存checkpoint，只保留最近的keep_last个和loss最小的那个。
+# start_iteration是这次训练的第一次迭代，checkpoints.json里迭代次数不小于它的checkpoint是以前另一次训练的，
+# 这次训练的第一个checkpoint写完之后它们才会被删除，在这之前以前的checkpoint和checkpoints.json都不变。
+class CheckpointWriter:
+    def __init__(self, directory, voc, start_iteration=1, keep_last=3):
+        self.directory = directory
+        self.voc = voc
+        self.keep_last = keep_last
+        self.voc_sha1 = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.index_file = os.path.join(directory, 'checkpoints.json')
+        self.checkpoints = []
+        if os.path.exists(self.index_file):
+            with open(self.index_file, encoding='utf-8') as f:
+                self.checkpoints = json.load(f)
+        self.stale = [entry for entry in self.checkpoints if entry['iteration'] >= start_iteration]
+        self.checkpoints = [entry for entry in self.checkpoints if entry['iteration'] < start_iteration]
+
+    def filename(self, iteration):
+        return os.path.join(self.directory, '{}_{}.tar'.format(iteration, 'checkpoint'))
+
+    # 先写临时文件再改名
+    def write(self, obj, filename):
+        tmp = filename + '.tmp'
+        if isinstance(obj, bytes):
+            with open(tmp, 'wb') as f:
+                f.write(obj)
+        else:
+            torch.save(obj, tmp)
+        os.replace(tmp, filename)
+
+    def remove(self, entries):
+        for entry in entries:
+            filename = self.filename(entry['iteration'])
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    # 在后台线程里执行
+    def saveSnapshot(self, state):
+        if self.voc_sha1 is None:
+            data = self.voc.toBytes()
+            self.write(data, os.path.join(self.directory, 'voc.bin'))
+            self.voc_sha1 = hashlib.sha1(data).hexdigest()
+        state['voc_sha1'] = self.voc_sha1
+        self.write(state, self.filename(state['iteration']))
+        # 同样迭代次数的旧checkpoint已经被新的覆盖了
+        self.remove([entry for entry in self.stale if entry['iteration'] != state['iteration']])
+        self.stale = []
+        self.checkpoints.append({'iteration': state['iteration'], 'loss': state['loss']})
+        # 最近的keep_last个和loss最小的那个
+        keep = self.checkpoints[-self.keep_last:] if self.keep_last > 0 else []
+        best = min(self.checkpoints, key=lambda entry: entry['loss'])
+        if best not in keep:
+            keep.append(best)
+        self.remove([entry for entry in self.checkpoints if entry not in keep])
+        self.checkpoints = sorted(keep, key=lambda entry: entry['iteration'])
+        self.write(json.dumps(self.checkpoints).encode('utf-8'), self.index_file)
+
+    # 复制state到CPU，然后在后台保存。state必须包含'iteration'和'loss'
+    def save(self, state):
+        self.wait()
+        self.pending = self.executor.submit(self.saveSnapshot, cpuSnapshot(state))
+
+    # 等待正在保存的checkpoint，后台线程出错的时候抛出它的异常
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
 
 
 # ### 训练迭代过程
@@ -1044,6 +1878,7 @@ def train(input_variable, lengths, target_variable, mask, max_target_len, encode
 # 最后是把前面的代码组合起来进行训练。函数``trainIters``用于进行``n_iterations``次minibatch的训练。
 # 
 # 值得注意的是我们定期会保存模型，我们会保存一个tar包，包括encoder和decoder的state_dicts(参数),优化器(optimizers)的state_dicts, loss和迭代次数。这样保存模型的好处是从中恢复后我们既可以进行预测也可以进行训练(因为有优化器的参数和迭代的次数)。
+# checkpoint由``CheckpointWriter``在后台保存，loss是从上一次保存到这一次的平均loss。如果loadFilename不空，那么从这个checkpoint的下一次迭代继续训练，并且恢复随机数的状态和sampler的位置。
 # 
 # 
 # 
@@ -1051,52 +1886,289 @@ def train(input_variable, lengths, target_variable, mask, max_target_len, encode
 # In[15]:
 
 
-def trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer, embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size, print_every, save_every, clip, corpus_name, loadFilename):
-
-    # 随机选择n_iteration个batch的数据(pair)
-    training_batches = [batch2TrainData(voc, [random.choice(pairs) for _ in range(batch_size)])
-                      for _ in range(n_iteration)]
-
-    # 初始化
-    print('Initializing ...')
+def trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer, embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size, print_every, save_every, clip, corpus_name, loadFilename, sampler=None, prefetch_workers=2, prefetch=8, pin_memory=False, sampling_schedule=None, sampling_decay=None, sampled_softmax=None, distributed=False, accumulation_steps=1, autocast=False, keep_last=3):
+
+    # 数据并行训练(参考trainDistributed)的时候，只有rank 0输出和保存checkpoint
+    rank = dist.get_rank() if distributed else 0
+    world_size = dist.get_world_size() if distributed else 1
+    if sampling_schedule:
+        checkSamplingSchedule(sampling_schedule, sampling_decay)
+
+    # 如果没有指定sampler，那么每次随机的从所有pair里选择batch个数据
+    if sampler is None:
+        sampler = RandomBatchSampler(pairs, batch_size)
+    # 比较随机采样和sampler的padding比例
+    if rank == 0:
+        print("Padding ratio: random {:.4f}, {} {:.4f}".format(
+            paddingRatio(pairs, itertools.islice(RandomBatchSampler(pairs, batch_size), 200)),
+            type(sampler).__name__, paddingRatio(pairs, itertools.islice(sampler, 200))))
+
+        # 初始化
+        print('Initializing ...')
+        if accumulation_steps > 1 or autocast:
+            print('Training with {} micro-batches of {} per step{}'.format(
+                accumulation_steps, batch_size, ', bf16 autocast' if autocast else ''))
     start_iteration = 1
+    start_batch = 0
     print_loss = 0
+    print_tokens = 0
+    print_start = time.time()
+    save_loss = 0
+    save_count = 0
     if loadFilename:
+        checkpoint = loadCheckpoint(loadFilename, map_location='cpu')
         start_iteration = checkpoint['iteration'] + 1
+        # 以前的checkpoint没有记录sampler的位置和随机数的状态
+        start_batch = checkpoint.get('batches', checkpoint['iteration'] * accumulation_steps)
+        if rank < len(checkpoint.get('rng', [])):
+            setRngState(checkpoint['rng'][rank])
+    if rank == 0:
+        directory = os.path.join(save_dir, model_name, corpus_name, '{}-{}_{}'.format(encoder_n_layers, decoder_n_layers, hidden_size))
+        writer = CheckpointWriter(directory, voc, start_iteration, keep_last)
+
+    # 用sampler从第start_batch个batch开始选择数据(pair)，在后台构造batch
+    # 梯度累积的时候每次迭代使用accumulation_steps个micro-batch
+    index_batches = itertools.islice(sampler.batches(start_batch),
+                                     max(n_iteration - start_iteration + 1, 0) * accumulation_steps)
+    training_batches = prefetchBatches(lambda batch: indexes2TrainData(pairs, batch),
+                                       index_batches, prefetch_workers, prefetch, pin_memory)
+    training_batches = zip(*[iter(training_batches)] * accumulation_steps)
 
     # 训练
-    print("Training...")
-    for iteration in range(start_iteration, n_iteration + 1):
-        training_batch = training_batches[iteration - 1]
-        
-        input_variable, lengths, target_variable, mask, max_target_len = training_batch
+    if rank == 0:
+        print("Training...")
+    for iteration, training_batch in zip(range(start_iteration, n_iteration + 1), training_batches):
+        input_variable, lengths, target_variable, mask, max_target_len = training_batch[0]
+        micro_batches = training_batch[1:]
 
         # 训练一个batch的数据
-        loss = train(input_variable, lengths, target_variable, mask, max_target_len, encoder,
-                     decoder, embedding, encoder_optimizer, decoder_optimizer, batch_size, clip)
+        if sampling_schedule:
+            # scheduled sampling，使用正确答案的概率随着迭代次数衰减
+            ratio = teacherForcingSchedule(iteration, sampling_schedule, sampling_decay)
+            loss = train(input_variable, lengths, target_variable, mask, max_target_len, encoder,
+                         decoder, embedding, encoder_optimizer, decoder_optimizer, batch_size, clip,
+                         forcing_ratio=ratio, scheduled_sampling=True, sampled_softmax=sampled_softmax,
+                         distributed=distributed, micro_batches=micro_batches, autocast=autocast)
+        else:
+            loss = train(input_variable, lengths, target_variable, mask, max_target_len, encoder,
+                         decoder, embedding, encoder_optimizer, decoder_optimizer, batch_size, clip,
+                         sampled_softmax=sampled_softmax, distributed=distributed,
+                         micro_batches=micro_batches, autocast=autocast)
         print_loss += loss
+        save_loss += loss
+        save_count += 1
+        # 统计非PAD的词数，用于计算训练速度(tokens/s)
+        for batch in training_batch:
+            print_tokens += int(batch[1].sum()) + int(batch[3].sum())
 
         # 进度
         if iteration % print_every == 0:
+            if distributed:
+                # 所有worker的loss求平均，词数求和
+                stats = torch.tensor([print_loss, print_tokens], dtype=torch.float64)
+                dist.all_reduce(stats)
+                print_loss = stats[0].item() / world_size
+                print_tokens = stats[1].item()
             print_loss_avg = print_loss / print_every
-            print("Iteration: {}; Percent complete: {:.1f}%; Average loss: {:.4f}".format(iteration, iteration / n_iteration * 100, print_loss_avg))
+            print_elapsed = time.time() - print_start
+            if rank == 0:
+                print("Iteration: {}; Percent complete: {:.1f}%; Average loss: {:.4f}; Tokens/s: {:.0f}".format(iteration, iteration / n_iteration * 100, print_loss_avg, print_tokens / print_elapsed))
             print_loss = 0
-
-        # 保存checkpoint
-        if (iteration % save_every == 0):
-            directory = os.path.join(save_dir, model_name, corpus_name, '{}-{}_{}'.format(encoder_n_layers, decoder_n_layers, hidden_size))
-            if not os.path.exists(directory):
-                os.makedirs(directory)
+            print_tokens = 0
+            print_start = time.time()
+
+        # 保存checkpoint，所有worker都要参与收集随机数的状态和loss
+        if iteration % save_every == 0:
+            rng = [rngState()]
+            save_loss /= save_count
+            if distributed:
+                rng = [None] * world_size
+                dist.all_gather_object(rng, rngState())
+                stats = torch.tensor([save_loss], dtype=torch.float64)
+                dist.all_reduce(stats)
+                save_loss = stats[0].item() / world_size
+            if rank == 0:
+                writer.save({
+                    'iteration': iteration,
+                    'en': encoder.state_dict(),
+                    'de': decoder.state_dict(),
+                    'en_opt': encoder_optimizer.state_dict(),
+                    'de_opt': decoder_optimizer.state_dict(),
+                    'loss': save_loss,
+                    'embedding': embedding.state_dict(),
+                    'rng': rng,
+                    'batches': start_batch + (iteration - start_iteration + 1) * accumulation_steps,
+                })
+            save_loss = 0
+            save_count = 0
+
+    # 等待最后一个checkpoint写完
+    if rank == 0:
+        writer.close()
+
+
+# ### 多进程的数据并行训练
+# 
+# GRU的矩阵乘法比较小，在CPU上训练的时候一个进程很难用满所有的核。``trainDistributed``用``torch.distributed``(gloo backend)启动n_workers个本地的worker进程进行数据并行的训练：
+# 
+# - worker用fork启动，因此它们直接继承了当前进程的模型、优化器和数据，不需要重新加载。开始训练之前用``broadcast``保证所有worker的参数和rank 0一样。
+# - 第rank个worker使用下标除以n_workers余rank的句对(shard)，用``BucketBatchSampler``从自己的shard里采样batch_size个句对，因此每次迭代一共使用n_workers x batch_size个句对。
+# - ``train``在反向计算之后调用``allreduceGradients``，把所有worker的梯度拼接成一个tensor用一次``all_reduce``求平均，然后再进行梯度裁剪和Adam的更新。所有worker的梯度和初始参数一样，因此更新之后的参数也一样。
+# - 只有rank 0输出训练的进度和保存checkpoint，训练结束之后rank 0把参数和优化器的状态写到一个临时文件，当前进程再加载它们，这样后面的测试使用的是训练之后的模型。
+# - 第rank个worker的随机数种子是seed x n_workers + rank，因此每个worker的dropout和scheduled sampling的随机选择都不一样。
+# - 每个worker使用cpu_count / n_workers个线程，n_workers一般设置成物理核的个数除以2或者4。
+# 
+# 
+
+# In[ ]:
+
+
+# 所有worker的梯度求平均，encoder和decoder共享的embedding只计算一次
+def allreduceGradients(*modules):
+    params = list({id(p): p for module in modules for p in module.parameters()}.values())
+    # 某个worker的batch没有用到的参数(比如adaptive softmax的tail)梯度是None，所有worker都用0代替，这样拼接后的大小一样。
+    # 最后再拼接每个参数是否有梯度的标记，所有worker都没有梯度的参数求平均之后仍然设置成None，这样Adam不会更新它，和单进程训练一样
+    has_grad = torch.tensor([p.grad is not None for p in params], dtype=torch.float32, device=params[0].device)
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    flat = torch.cat([p.grad.reshape(-1) for p in params] + [has_grad])
+    dist.all_reduce(flat)
+    has_grad = flat[-len(params):].tolist()
+    flat /= dist.get_world_size()
+    offset = 0
+    for p, used in zip(params, has_grad):
+        if used:
+            p.grad.copy_(flat[offset:offset + p.numel()].view_as(p.grad))
+        else:
+            p.grad = None
+        offset += p.numel()
+
+
+def trainDistributed(n_workers, model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer,
+                     embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size, print_every,
+                     save_every, clip, corpus_name, loadFilename, seed=0, **kwargs):
+    args = (model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer, embedding,
+            encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size, print_every, save_every,
+            clip, corpus_name, loadFilename)
+    # 没有fork(比如Windows)的时候在当前进程里训练
+    if n_workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return trainIters(*args, **kwargs)
+    kwargs.pop('sampler', None)
+    if kwargs.get('sampling_schedule'):
+        checkSamplingSchedule(kwargs['sampling_schedule'], kwargs.get('sampling_decay'))
+
+    # rank 0监听的端口，随便找一个空闲的
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        init_method = 'tcp://127.0.0.1:{}'.format(sock.getsockname()[1])
+    fd, result_file = tempfile.mkstemp(suffix='.tar')
+    os.close(fd)
+
+    def worker(rank):
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_workers))
+        dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=n_workers)
+        for module in (encoder, decoder):
+            for tensor in module.state_dict().values():
+                dist.broadcast(tensor, 0)
+        # fork之后所有worker的随机数状态都一样，每个worker用不同的种子，这样dropout和scheduled sampling的随机选择不同。
+        # 从checkpoint继续训练的时候trainIters会恢复每个worker保存的状态
+        worker_seed = seed * n_workers + rank
+        random.seed(worker_seed)
+        np.random.seed(worker_seed)
+        torch.manual_seed(worker_seed)
+        shard = pairs.select(np.arange(len(pairs)) % n_workers == rank)
+        sampler = BucketBatchSampler(shard, batch_size, seed)
+        trainIters(*args[:2], shard, *args[3:], sampler=sampler, distributed=True, **kwargs)
+        if rank == 0:
             torch.save({
-                'iteration': iteration,
                 'en': encoder.state_dict(),
                 'de': decoder.state_dict(),
                 'en_opt': encoder_optimizer.state_dict(),
                 'de_opt': decoder_optimizer.state_dict(),
-                'loss': loss,
-                'voc_dict': voc.__dict__,
-                'embedding': embedding.state_dict()
-            }, os.path.join(directory, '{}_{}.tar'.format(iteration, 'checkpoint')))
+            }, result_file)
+        dist.destroy_process_group()
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=worker, args=(rank,)) for rank in range(n_workers)]
+    for process in processes:
+        process.start()
+    try:
+        # 某个worker出错退出的时候，其它的worker会一直等待all_reduce，因此要把它们都结束
+        while any(process.exitcode is None for process in processes):
+            for process in processes:
+                process.join(0.5)
+                if process.exitcode not in (None, 0):
+                    for other in processes:
+                        other.terminate()
+                    raise RuntimeError('training worker exited with code {}'.format(process.exitcode))
+        state = torch.load(result_file, weights_only=False)
+        encoder.load_state_dict(state['en'])
+        decoder.load_state_dict(state['de'])
+        encoder_optimizer.load_state_dict(state['en_opt'])
+        decoder_optimizer.load_state_dict(state['de_opt'])
+    finally:
+        os.remove(result_file)
+
+
+# ### bf16和梯度累积
+# 
+# ``train``还支持两个选项：
+# 
+# - **梯度累积**：内存不够放下一个大的batch(比如512)的时候，可以把它分成几个micro-batch(比如8个64)，每个micro-batch分别forward和backward，梯度会累加起来，最后再进行一次梯度裁剪和更新。
+# 为了让结果和一个大的batch完全一样，``train``先统计整个batch每个时刻非padding的词数nTotals，每个micro-batch的loss都除以这个总数(而不是micro-batch自己的词数)，
+# 这样micro-batch的loss加起来就正好等于整个batch的loss。是否teacher forcing对整个batch只决定一次。``trainIters``的accumulation_steps参数设置每次更新使用几个micro-batch。
+# - **bf16 autocast**：在``torch.autocast``里进行forward和loss的计算，Linear和bmm等操作会使用bfloat16，在支持bf16指令的CPU上更快，GRU和loss仍然使用fp32。
+# 参数和Adam的状态都还是fp32的，梯度也是fp32的，因此不需要loss scaling。
+# 
+# ``compareTraining``用同样的初始参数和同样的数据比较一个大batch、梯度累积和梯度累积+bf16三种设置的训练速度(tokens/s)和loss曲线。
+# 为了只比较数值上的差别，比较的时候关闭了dropout，并且总是使用teacher forcing。
+# 
+# 
+
+# In[ ]:
+
+
+def compareTraining(encoder, decoder, pairs, batch_size, accumulation_steps, n_iteration, clip, learning_rate,
+                    decoder_learning_ratio):
+    sampler = BucketBatchSampler(pairs, batch_size)
+    index_batches = list(itertools.islice(sampler.batches(), n_iteration * accumulation_steps))
+    steps = [index_batches[i:i + accumulation_steps] for i in range(0, len(index_batches), accumulation_steps)]
+    modes = [
+        ('fp32 batch {}'.format(batch_size * accumulation_steps), 1, False),
+        ('fp32 {} x {}'.format(accumulation_steps, batch_size), accumulation_steps, False),
+        ('bf16 {} x {}'.format(accumulation_steps, batch_size), accumulation_steps, True),
+    ]
+    curves = []
+    for name, micro_steps, autocast in modes:
+        model_encoder, model_decoder = copy.deepcopy((encoder, decoder))
+        # cuDNN的RNN在eval模式下不能反向计算，因此保持train模式，直接把dropout的概率设置成0
+        model_encoder.train()
+        model_decoder.train()
+        for module in itertools.chain(model_encoder.modules(), model_decoder.modules()):
+            if isinstance(module, nn.Dropout):
+                module.p = 0.0
+            elif isinstance(module, nn.RNNBase):
+                module.dropout = 0.0
+        encoder_optimizer = optim.Adam(model_encoder.parameters(), lr=learning_rate)
+        decoder_optimizer = optim.Adam(model_decoder.parameters(), lr=learning_rate * decoder_learning_ratio)
+        losses = []
+        n_tokens = 0
+        start = time.time()
+        for step in steps:
+            # 一个大batch的时候把所有micro-batch的句对合并起来
+            if micro_steps == 1:
+                step = [np.concatenate(step)]
+            batches = [indexes2TrainData(pairs, indices) for indices in step]
+            n_tokens += sum(int(batch[1].sum()) + int(batch[3].sum()) for batch in batches)
+            losses.append(train(*batches[0], model_encoder, model_decoder, model_encoder.embedding,
+                                encoder_optimizer, decoder_optimizer, batches[0][0].size(1), clip,
+                                forcing_ratio=1.0, micro_batches=batches[1:], autocast=autocast))
+        elapsed = time.time() - start
+        curves.append(losses)
+        print('{}: tokens/s: {:.0f}; final loss: {:.4f}; max loss difference: {:.4f}'.format(
+            name, n_tokens / elapsed, losses[-1], max(abs(a - b) for a, b in zip(losses, curves[0]))))
+    return curves
 
 
 # ## 效果测试
@@ -1138,17 +2210,20 @@ class GreedySearchDecoder(nn.Module):
         # Encoder的Forward计算 
         encoder_outputs, encoder_hidden = self.encoder(input_seq, input_length)
         # 把Encoder最后时刻的隐状态作为Decoder的初始值
-        decoder_hidden = encoder_hidden[:decoder.n_layers]
+        decoder_hidden = encoder_hidden[:self.decoder.n_layers]
         # 因为我们的函数都是要求(time,batch)，因此即使只有一个数据，也要做出二维的。
         # Decoder的初始输入是SOS
         decoder_input = torch.ones(1, 1, device=device, dtype=torch.long) * SOS_token
         # 用于保存解码结果的tensor
         all_tokens = torch.zeros([0], device=device, dtype=torch.long)
         all_scores = torch.zeros([0], device=device)
+        # 预先计算注意力的keys
+        encoder_keys = self.decoder.precompute(encoder_outputs)
         # 循环，这里只使用长度限制，后面处理的时候把EOS去掉了。
         for _ in range(max_length):
             # Decoder forward一步
-            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs)
+            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs,
+                                                          encoder_keys=encoder_keys)
             # decoder_outputs是(batch=1, vob_size)
             # 使用max返回概率最大的词和得分
             decoder_scores, decoder_input = torch.max(decoder_output, dim=1)
@@ -1162,6 +2237,152 @@ class GreedySearchDecoder(nn.Module):
         return all_tokens, all_scores
 
 
+# ### 批量的贪心解码
+# 
+# ``GreedySearchDecoder``一次只能处理一个句子，而且即使已经输出了EOS也要循环max_length次，每次还要用``torch.cat``拼接结果。
+# 批量处理很多句子(比如离线的处理大量输入，或者后面的服务器把多个请求合并成一个batch)的时候，我们可以使用下面的``BatchGreedySearchDecoder``：
+# 
+# - 输入是padding之后的(max_length, batch)的tensor和每个句子的长度，句子的顺序是任意的(它会先按长度排序，因为pack_padded_sequence要求从长到短，最后再恢复原来的顺序)。
+# - 预先分配保存结果的tensor，每个时刻直接写入。
+# - 记录每个句子是否已经输出过EOS，输出过EOS的句子后面都输出PAD，所有的句子都结束了就停止循环。
+# 
+# 它返回的tokens和scores的shape是(batch, 解码的长度)。
+# 
+# 
+
+# In[ ]:
+
+
+class BatchGreedySearchDecoder(nn.Module):
+    def __init__(self, encoder, decoder):
+        super(BatchGreedySearchDecoder, self).__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def forward(self, input_seq, input_lengths, max_length):
+        batch_size = input_seq.size(1)
+        # 按长度从长到短排序，order[i]是排序后第i个句子原来的下标
+        input_lengths, order = torch.sort(input_lengths.cpu(), descending=True)
+        input_seq = input_seq[:, order.to(input_seq.device)]
+        encoder_outputs, encoder_hidden = self.encoder(input_seq, input_lengths)
+        decoder_hidden = encoder_hidden[:self.decoder.n_layers]
+        decoder_input = torch.full((1, batch_size), SOS_token, device=device, dtype=torch.long)
+        # 预先分配保存解码结果的tensor
+        all_tokens = torch.full((max_length, batch_size), PAD_token, device=device, dtype=torch.long)
+        all_scores = torch.zeros(max_length, batch_size, device=device)
+        finished = torch.zeros(batch_size, device=device, dtype=torch.bool)
+        encoder_keys = self.decoder.precompute(encoder_outputs)
+        encoder_mask = sourceMask(input_lengths, encoder_outputs.size(0), device)
+        length = max_length
+        for t in range(max_length):
+            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs,
+                                                          encoder_keys=encoder_keys, encoder_mask=encoder_mask)
+            decoder_scores, decoder_input = torch.max(decoder_output, dim=1)
+            # 已经结束的句子输出PAD，得分是0
+            decoder_input = decoder_input.masked_fill(finished, PAD_token)
+            all_tokens[t] = decoder_input
+            all_scores[t] = decoder_scores.masked_fill(finished, 0)
+            finished = finished | (decoder_input == EOS_token)
+            if bool(finished.all()):
+                length = t + 1
+                break
+            decoder_input = decoder_input.unsqueeze(0)
+        # 恢复原来的顺序，(length, batch)转置成(batch, length)
+        inverse = torch.empty_like(order)
+        inverse[order] = torch.arange(batch_size)
+        inverse = inverse.to(all_tokens.device)
+        return all_tokens[:length, inverse].t(), all_scores[:length, inverse].t()
+
+
+# ### Beam Search
+# 
+# 贪心解码每个时刻只保留概率最高的一个词，得到的回复经常是很通用和重复的。Beam Search每个时刻保留累计概率(log概率之和)最高的K(beam_size)个候选(hypothesis)，
+# 下一个时刻把这K个候选分别输入decoder，然后从K x 词典大小个扩展里再选择最好的K个。
+# 
+# ``BeamSearchDecoder``把batch个句子的K个beam展开成一个大小为batch x K的batch，所有的计算都是tensor操作，没有对beam的Python循环：
+# 
+# - encoder的输出和隐状态用``index_select``复制K份。
+# - 每个时刻对(K, 词典大小)的得分一起做topk，得到新的K个beam来自哪个旧的beam以及新的词，然后用``index_select``重新排列decoder的隐状态和已经生成的词。
+# - 已经输出EOS的beam只能继续输出PAD，并且得分不变，这样它们就可以和其它的beam一起比较，而不需要把它们从tensor里删除。所有的beam都结束了就停止。
+# - 最后对得分进行长度归一化：除以长度的alpha次方(length_penalty)，否则短的回复的log概率之和总是更大。alpha=0表示不进行归一化。
+# 
+# 它返回的tokens是每个句子最好的回复，shape是(batch, 解码的长度)，scores是归一化之后的得分，shape是(batch,)。
+# 
+# 
+
+# In[ ]:
+
+
+class BeamSearchDecoder(nn.Module):
+    def __init__(self, encoder, decoder, beam_size=5, length_penalty=1.0):
+        super(BeamSearchDecoder, self).__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+        self.beam_size = beam_size
+        self.length_penalty = length_penalty
+
+    def forward(self, input_seq, input_lengths, max_length):
+        batch_size = input_seq.size(1)
+        # beam的个数不能超过词典的大小
+        K = min(self.beam_size, self.decoder.output_size)
+        input_lengths, order = torch.sort(input_lengths.cpu(), descending=True)
+        input_seq = input_seq[:, order.to(input_seq.device)]
+        encoder_outputs, encoder_hidden = self.encoder(input_seq, input_lengths)
+        # 每个句子复制K份，第i个句子的beam是i*K到i*K+K-1
+        beam_index = torch.arange(batch_size, device=device).repeat_interleave(K)
+        encoder_keys = self.decoder.precompute(encoder_outputs).index_select(1, beam_index)
+        encoder_mask = sourceMask(input_lengths, encoder_outputs.size(0), device).index_select(1, beam_index)
+        encoder_outputs = encoder_outputs.index_select(1, beam_index)
+        decoder_hidden = encoder_hidden[:self.decoder.n_layers].index_select(1, beam_index)
+        decoder_input = torch.full((1, batch_size * K), SOS_token, device=device, dtype=torch.long)
+        # 每个beam的累计log概率，一开始所有的beam都是一样的，因此只保留第一个，否则topk会选出K个一样的候选
+        beam_scores = torch.full((batch_size, K), float('-inf'), device=device)
+        beam_scores[:, 0] = 0
+        beam_scores = beam_scores.view(-1)
+        # 每个beam的长度(包括EOS)以及是否已经结束
+        beam_lengths = torch.zeros(batch_size * K, device=device)
+        finished = torch.zeros(batch_size * K, device=device, dtype=torch.bool)
+        # 已经结束的beam的log概率：只能输出PAD，并且log概率是0
+        finished_log_probs = torch.full((self.decoder.output_size,), float('-inf'), device=device)
+        finished_log_probs[PAD_token] = 0
+        # 每个beam生成的词
+        all_tokens = torch.full((max_length, batch_size * K), PAD_token, device=device, dtype=torch.long)
+        # 第i个句子的beam在展开后的batch里的起始位置
+        beam_offsets = (torch.arange(batch_size, device=device) * K).unsqueeze(1)
+        length = max_length
+        for t in range(max_length):
+            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs,
+                                                          return_logits=True, encoder_keys=encoder_keys,
+                                                          encoder_mask=encoder_mask)
+            log_probs = torch.where(finished.unsqueeze(1), finished_log_probs, F.log_softmax(decoder_output, dim=1))
+            # (batch*K, V) -> (batch, K*V)，然后对每个句子选择最好的K个
+            scores = (beam_scores.unsqueeze(1) + log_probs).view(batch_size, -1)
+            top_scores, top_index = scores.topk(K, dim=1)
+            # 新的beam来自哪个旧的beam(在展开后的batch里的下标)以及新的词
+            origin = (top_index // self.decoder.output_size + beam_offsets).view(-1)
+            tokens = (top_index % self.decoder.output_size).view(-1)
+            beam_scores = top_scores.view(-1)
+            decoder_hidden = decoder_hidden.index_select(1, origin)
+            all_tokens = all_tokens.index_select(1, origin)
+            all_tokens[t] = tokens
+            finished = finished.index_select(0, origin)
+            beam_lengths = beam_lengths.index_select(0, origin) + (~finished).float()
+            finished = finished | (tokens == EOS_token)
+            if bool(finished.all()):
+                length = t + 1
+                break
+            decoder_input = tokens.unsqueeze(0)
+        # 长度归一化，然后选择每个句子最好的beam
+        normalized = (beam_scores / beam_lengths.clamp(min=1) ** self.length_penalty).view(batch_size, K)
+        best_scores, best = normalized.max(dim=1)
+        best = best + beam_offsets.squeeze(1)
+        # 恢复原来的顺序
+        inverse = torch.empty_like(order)
+        inverse[order] = torch.arange(batch_size)
+        inverse = inverse.to(all_tokens.device)
+        return all_tokens[:length, best[inverse]].t(), best_scores[inverse]
+
+
 # ### 自己对话函数
 # 
 # 
@@ -1183,9 +2404,8 @@ def evaluate(encoder, decoder, searcher, voc, sentence, max_length=MAX_LENGTH):
     lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
     # 转置 
     input_batch = torch.LongTensor(indexes_batch).transpose(0, 1)
-    # 放到合适的设备上(比如GPU)
+    # 放到合适的设备上(比如GPU)，lengths留在CPU上给pack_padded_sequence使用
     input_batch = input_batch.to(device)
-    lengths = lengths.to(device)
     # 用searcher解码
     tokens, scores = searcher(input_batch, lengths, max_length)
     # ID变成词。
@@ -1193,7 +2413,8 @@ def evaluate(encoder, decoder, searcher, voc, sentence, max_length=MAX_LENGTH):
     return decoded_words
 
 
-def evaluateInput(encoder, decoder, searcher, voc):
+# cache是可选的ResponseCache，归一化之后相同的输入直接返回缓存的回复。
+def evaluateInput(encoder, decoder, searcher, voc, normalize=normalizeStringFast, cache=None):
     input_sentence = ''
     while(1):
         try:
@@ -1202,22 +2423,352 @@ def evaluateInput(encoder, decoder, searcher, voc):
             # 是否退出
             if input_sentence == 'q' or input_sentence == 'quit': break
             # 句子归一化
-            input_sentence = normalizeString(input_sentence)
-            # 生成响应Evaluate sentence
-            output_words = evaluate(encoder, decoder, searcher, voc, input_sentence)
-            # 去掉EOS后面的内容
-            words = []
-            for word in output_words:
-                if word == 'EOS':
-                    break
-                elif word != 'PAD':
-                    words.append(word)
+            input_sentence = normalize(input_sentence)
+            words = None
+            # 包含未知词的句子不查缓存，evaluate会抛出KeyError
+            if cache is not None and all(word in voc.word2index for word in input_sentence.split(' ')):
+                key = cache.key(input_sentence, searcher, MAX_LENGTH)
+                words = cache.get(key)
+            if words is None:
+                # 生成响应Evaluate sentence
+                output_words = evaluate(encoder, decoder, searcher, voc, input_sentence)
+                # 去掉EOS后面的内容
+                words = []
+                for word in output_words:
+                    if word == 'EOS':
+                        break
+                    elif word != 'PAD':
+                        words.append(word)
+                if cache is not None:
+                    cache.put(cache.key(input_sentence, searcher, MAX_LENGTH), words)
             print('Bot:', ' '.join(words))
 
         except KeyError:
             print("Error: Encountered unknown word.")
 
 
+# 批量的生成回复，sentences是归一化之后的句子的list，searcher是BatchGreedySearchDecoder这样的批量的searcher。
+# 返回每个句子的回复(词的list，去掉了EOS和PAD)，包含未知词的句子返回None。
+# 同一个batch里重复的句子只解码一次。cache是可选的ResponseCache，只有没有命中缓存的句子才会进行解码，
+# 重复的句子只查一次缓存，包含未知词的句子不查缓存，因此它们都不影响命中率。
+def evaluateBatch(searcher, voc, sentences, max_length=MAX_LENGTH, cache=None):
+    replies = [None] * len(sentences)
+    indexes_batch = []
+    valid = []
+    # 每个不同的句子第一次出现的下标，重复的句子最后复制它的回复
+    first = {}
+    duplicates = []
+    for i, sentence in enumerate(sentences):
+        if sentence in first:
+            duplicates.append((i, first[sentence]))
+            continue
+        first[sentence] = i
+        try:
+            indexes = [voc.word2index[word] for word in sentence.split(' ')]
+        except KeyError:
+            continue
+        if cache is not None:
+            words = cache.get(cache.key(sentence, searcher, max_length))
+            if words is not None:
+                replies[i] = words
+                continue
+        indexes_batch.append(indexes)
+        valid.append(i)
+    if valid:
+        # 把所有句子的ID拼接起来，然后用padTokens加上EOS并且padding
+        offsets = np.zeros(len(indexes_batch) + 1, dtype=np.int64)
+        np.cumsum([len(indexes) for indexes in indexes_batch], out=offsets[1:])
+        tokens = np.fromiter(itertools.chain.from_iterable(indexes_batch), dtype=np.int64, count=int(offsets[-1]))
+        input_batch, lengths = padTokens(tokens, offsets[:-1], offsets[1:])
+        with torch.no_grad():
+            output_tokens, _ = searcher(input_batch.to(device), lengths, max_length)
+        # 一次把结果复制到CPU，然后变成词
+        for i, output in zip(valid, output_tokens.tolist()):
+            words = []
+            for token in output:
+                if token == EOS_token or token == PAD_token:
+                    break
+                words.append(voc.index2word[token])
+            replies[i] = words
+            if cache is not None:
+                cache.put(cache.key(sentences[i], searcher, max_length), words)
+    for i, j in duplicates:
+        if replies[j] is not None:
+            replies[i] = list(replies[j])
+    return replies
+
+
+# ### 回复的缓存
+# 
+# 实际的对话里很多输入归一化之后是完全一样的(比如"hi"、"how are you ?"和"what ?")，对于同一个模型和同样的解码设置，
+# 贪心解码和beam search的结果都是确定的，因此可以把回复缓存起来，下次遇到同样的输入直接返回，而不需要再运行encoder和decoder。
+# 
+# ``ResponseCache``是一个有大小限制的LRU缓存，超过max_size的时候删除最久没有使用的回复，ttl(秒)不是None的时候，超过ttl的回复也会失效。
+# 缓存的key是模型的标识、归一化之后的句子加上searcher的设置(类名、beam_size和length_penalty这些参数以及max_length)。
+# 模型变了之后缓存的回复就不对了，因此缓存会记录模型的标识(``checkpointIdentity``计算的参数的hash)，
+# 调用``bind``设置一个不同的标识(比如加载了另一个checkpoint)的时候会清空缓存。没有调用过``bind``的缓存不会保存和返回任何回复。
+# hits和misses记录命中和没有命中的次数。
+# 
+# 
+
+# In[ ]:
+
+
+# 模型的标识，它是所有参数(包括embedding)的sha1，加载了不同的checkpoint或者继续训练之后标识就会改变。
+def checkpointIdentity(*modules):
+    h = hashlib.sha1()
+    for module in modules:
+        for name, tensor in module.state_dict().items():
+            h.update(name.encode('utf-8'))
+            h.update(tensor.detach().cpu().contiguous().flatten().view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_size=10000, ttl=None):
+        if max_size < 1:
+            raise ValueError(max_size, "is not an appropriate cache size.")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.checkpoint = None
+        # key -> (回复, 失效的时间)，按照最近使用的顺序排列，最后一个是最近使用的
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # 使用标识为checkpoint的模型，如果和原来的模型不同，那么清空缓存
+    def bind(self, checkpoint):
+        if checkpoint != self.checkpoint:
+            self.clear()
+            self.checkpoint = checkpoint
+
+    def clear(self):
+        self.entries.clear()
+
+    # 缓存的key包括模型的标识，searcher的设置是它的int、float、str和bool类型的属性，比如beam_size和length_penalty
+    def key(self, sentence, searcher, max_length):
+        settings = tuple(sorted((name, value) for name, value in vars(searcher).items()
+                                if isinstance(value, (int, float, str, bool))))
+        return self.checkpoint, sentence, type(searcher).__name__, settings, max_length
+
+    # 返回缓存的回复(词的list)，没有命中返回None。没有调用过bind的时候不知道是哪个模型，因此总是返回None
+    def get(self, key):
+        entry = self.entries.get(key) if key[0] is not None else None
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return list(entry[0])
+
+    def put(self, key, words):
+        if key[0] is None:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (list(words), expires)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# ### 批量处理请求的服务器
+# 
+# ``evaluateInput``一次只能处理一个终端输入的句子。实际部署的时候会有很多用户同时发送请求，如果一个一个的处理，那么吞吐量总是1/(一个句子的延迟)。
+# 下面的``serveChat``用asyncio实现了一个简单的HTTP服务器(监听localhost的端口或者一个Unix socket)，它使用前面的批量searcher同时处理多个请求：
+# 
+# - 每个请求的句子归一化之后放到一个队列里。
+# - ``ChatBatcher``从队列里取出第一个请求之后，最多再等待max_wait秒，把这段时间里到达的请求(最多max_batch_size个)组成一个batch(micro-batch)。
+# - batch通过``evaluateBatch``在一个后台线程里解码，这样asyncio的事件循环可以继续接收请求。解码的时候到达的请求会组成下一个batch，因此并发的请求越多，batch就越大，吞吐量也越高。
+# 
+# 请求的格式是``POST /chat``，body是``{"text": "how are you?"}``，返回``{"reply": "i m fine ."}``。包含未知词的句子返回400错误。``GET /stats``返回请求数、batch数、平均的batch大小和缓存的命中率。比如：
+# 
+# ```
+# curl -d '{"text": "hello"}' http://127.0.0.1:8000/chat
+# curl --unix-socket /tmp/chatbot.sock -d '{"text": "hello"}' http://localhost/chat
+# ```
+# 
+# 注意：``serveChat``使用``asyncio.run``，它会一直运行直到按Ctrl-C，在Jupyter notebook里需要用``await serveChatAsync(...)``。
+# 
+# 
+
+# In[ ]:
+
+
+class ChatBatcher:
+    def __init__(self, searcher, voc, max_batch_size=32, max_wait=0.005, max_length=MAX_LENGTH, cache=None,
+                 normalize=normalizeStringFast):
+        if max_batch_size < 1:
+            raise ValueError(max_batch_size, "is not an appropriate batch size.")
+        self.searcher = searcher
+        self.voc = voc
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_length = max_length
+        self.cache = cache
+        self.normalize = normalize
+        self.queue = asyncio.Queue()
+        # 解码在这个线程里进行，同一时刻只有一个batch在解码
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.requests = 0
+        self.batches = 0
+
+    # 提交一个句子，返回回复(词的list)，包含未知词的句子返回None
+    async def submit(self, sentence):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((self.normalize(sentence), future))
+        return await future
+
+    # 从队列里收集一个batch：第一个请求到达之后最多等待max_wait秒
+    async def nextBatch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.nextBatch()
+            sentences = [sentence for sentence, _ in batch]
+            try:
+                replies = await loop.run_in_executor(self.executor, evaluateBatch, self.searcher, self.voc,
+                                                     sentences, self.max_length, self.cache)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.requests += len(batch)
+            self.batches += 1
+            for (_, future), reply in zip(batch, replies):
+                # 客户端断开的时候future可能已经被取消了
+                if not future.done():
+                    future.set_result(reply)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'cache_hit_rate': self.cache.hitRate() if self.cache is not None else None,
+        }
+
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                500: 'Internal Server Error'}
+
+
+# 处理一个HTTP请求，返回状态码和JSON对象
+async def handleRequest(batcher, method, target, body):
+    if target == '/stats':
+        return 200, batcher.stats()
+    if target != '/chat':
+        return 404, {'error': 'not found'}
+    if method != 'POST':
+        return 405, {'error': 'use POST'}
+    try:
+        text = json.loads(body.decode('utf-8'))['text']
+    except (ValueError, KeyError, TypeError):
+        return 400, {'error': 'body must be a JSON object with a "text" field'}
+    if not isinstance(text, str):
+        return 400, {'error': '"text" must be a string'}
+    try:
+        words = await batcher.submit(text)
+    except Exception as e:
+        return 500, {'error': str(e)}
+    if words is None:
+        return 400, {'error': 'unknown word'}
+    return 200, {'reply': ' '.join(words)}
+
+
+# 处理一个连接，支持HTTP/1.1的keep-alive，一个连接可以发送多个请求
+async def handleConnection(batcher, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, payload = await handleRequest(batcher, method, target, body)
+            data = json.dumps(payload).encode('utf-8')
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                         'Connection: {}\r\n\r\n'.format(status, HTTP_REASONS[status], len(data),
+                                                        'keep-alive' if keep_alive else 'close').encode('latin-1'))
+            writer.write(data)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+# 启动服务器，path不是None的时候监听Unix socket，否则监听host:port
+async def serveChatAsync(searcher, voc, host='127.0.0.1', port=8000, path=None, max_batch_size=32,
+                         max_wait=0.005, cache=None):
+    batcher = ChatBatcher(searcher, voc, max_batch_size, max_wait, cache=cache)
+    handler = functools.partial(handleConnection, batcher)
+    if path is not None:
+        # 删除上次运行留下的socket文件
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(handler, path=path)
+        print('Serving on unix:{}'.format(path))
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        print('Serving on http://{}:{}'.format(host, port))
+    batch_task = asyncio.ensure_future(batcher.run())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+        batcher.executor.shutdown(wait=False)
+        print('Server stats:', batcher.stats())
+
+
+def serveChat(searcher, voc, host='127.0.0.1', port=8000, path=None, max_batch_size=32, max_wait=0.005,
+              cache=None):
+    try:
+        asyncio.run(serveChatAsync(searcher, voc, host, port, path, max_batch_size, max_wait, cache))
+    except KeyboardInterrupt:
+        pass
+
+
 # ## 训练和测试模型
 # 
 # 最后我们可以来训练模型和进行评测了。 
@@ -1240,6 +2791,8 @@ encoder_n_layers = 2
 decoder_n_layers = 2
 dropout = 0.1
 batch_size = 64
+# 输出层是否使用adaptive softmax，词典很大的时候可以减少输出层的计算量
+adaptive_softmax = False
 
 # 从哪个checkpoint恢复，如果是None，那么从头开始训练。
 loadFilename = None
@@ -1249,15 +2802,15 @@ checkpoint_iter = 2
 # 如果loadFilename不空，则从中加载模型 
 if loadFilename:
     # 如果训练和加载是一条机器，那么直接加载 
-    checkpoint = torch.load(loadFilename)
+    checkpoint = loadCheckpoint(loadFilename)
     # 否则比如checkpoint是在GPU上得到的，但是我们现在又用CPU来训练或者测试，那么注释掉下面的代码
-    #checkpoint = torch.load(loadFilename, map_location=torch.device('cpu'))
+    #checkpoint = loadCheckpoint(loadFilename, map_location=torch.device('cpu'))
     encoder_sd = checkpoint['en']
     decoder_sd = checkpoint['de']
     encoder_optimizer_sd = checkpoint['en_opt']
     decoder_optimizer_sd = checkpoint['de_opt']
     embedding_sd = checkpoint['embedding']
-    voc.__dict__ = checkpoint['voc_dict']
+    voc = checkpoint['voc']
 
 
 print('Building encoder and decoder ...')
@@ -1267,7 +2820,8 @@ if loadFilename:
     embedding.load_state_dict(embedding_sd)
 # 初始化encoder和decoder模型
 encoder = EncoderRNN(hidden_size, embedding, encoder_n_layers, dropout)
-decoder = LuongAttnDecoderRNN(attn_model, embedding, hidden_size, voc.num_words, decoder_n_layers, dropout)
+decoder = LuongAttnDecoderRNN(attn_model, embedding, hidden_size, voc.num_words, decoder_n_layers, dropout,
+                              targetCounts(voc) if adaptive_softmax else None)
 if loadFilename:
     encoder.load_state_dict(encoder_sd)
     decoder.load_state_dict(decoder_sd)
@@ -1291,11 +2845,34 @@ print('Models built and ready to go!')
 # 配置训练的超参数和优化器 
 clip = 50.0
 teacher_forcing_ratio = 1.0
+# scheduled sampling的衰减方法('linear'、'exponential'或者'inverse_sigmoid')和参数k(默认值见DEFAULT_SAMPLING_DECAY)，
+# 如果是None，那么使用固定的teacher_forcing_ratio
+sampling_schedule = None
+sampling_decay = DEFAULT_SAMPLING_DECAY.get(sampling_schedule)
 learning_rate = 0.0001
 decoder_learning_ratio = 5.0
 n_iteration = 100
 print_every = 1
 save_every = 500
+# 只保留最近的keep_last个checkpoint和loss最小的那个
+keep_last = 3
+# 按长度分桶采样batch，如果设置成None，则每次随机的从所有pair里选择batch个数据
+sampler = BucketBatchSampler(pairs, batch_size)
+# 构造batch的后台线程数和最多提前构造的batch数，使用GPU的时候把batch放到pinned memory里
+prefetch_workers = 2
+prefetch = 8
+pin_memory = USE_CUDA
+# 梯度累积：每次更新使用accumulation_steps个batch_size的micro-batch，autocast为True的时候使用bf16计算forward和loss
+accumulation_steps = 1
+autocast = False
+# 是否在训练之前比较一个大batch、梯度累积和bf16的速度和loss曲线
+compare_training = False
+# 数据并行训练的worker个数，大于1的时候使用trainDistributed，每次迭代一共使用train_workers x batch_size个句对
+train_workers = 1
+# sampled softmax的负样本个数，如果是None，那么使用完整的softmax。词典很大(比如10万以上)的时候可以设置成比如4096
+# 使用adaptive softmax的时候不能使用sampled softmax
+num_sampled = None
+sampled_softmax = SampledSoftmaxLoss(voc, num_sampled) if num_sampled and not adaptive_softmax else None
 
 # 设置进入训练模式，从而开启dropout 
 encoder.train()
@@ -1309,11 +2886,25 @@ if loadFilename:
     encoder_optimizer.load_state_dict(encoder_optimizer_sd)
     decoder_optimizer.load_state_dict(decoder_optimizer_sd)
 
+if compare_training:
+    # 比较8 x batch_size的大batch和8个micro-batch的梯度累积，各训练20次迭代
+    compareTraining(encoder, decoder, pairs, batch_size, 8, 20, clip, learning_rate, decoder_learning_ratio)
+
 # 开始训练
 print("Starting Training!")
-trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer,
-           embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size,
-           print_every, save_every, clip, corpus_name, loadFilename)
+if train_workers > 1:
+    trainDistributed(train_workers, model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer,
+                     embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size,
+                     print_every, save_every, clip, corpus_name, loadFilename,
+                     prefetch_workers=prefetch_workers, prefetch=prefetch, sampling_schedule=sampling_schedule,
+                     sampling_decay=sampling_decay, sampled_softmax=sampled_softmax,
+                     accumulation_steps=accumulation_steps, autocast=autocast, keep_last=keep_last)
+else:
+    trainIters(model_name, voc, pairs, encoder, decoder, encoder_optimizer, decoder_optimizer,
+               embedding, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size,
+               print_every, save_every, clip, corpus_name, loadFilename, sampler,
+               prefetch_workers, prefetch, pin_memory, sampling_schedule, sampling_decay, sampled_softmax,
+               accumulation_steps=accumulation_steps, autocast=autocast, keep_last=keep_last)
 
 
 # ### 测试
@@ -1333,8 +2924,277 @@ decoder.eval()
 # 构造searcher对象 
 searcher = GreedySearchDecoder(encoder, decoder)
 
-# 测试
-evaluateInput(encoder, decoder, searcher, voc)
+# 回复的缓存，模型(checkpoint)变了之后要重新调用bind
+response_cache = ResponseCache(max_size=10000, ttl=3600)
+response_cache.bind(checkpointIdentity(encoder, decoder))
+
+# 批量解码一些训练数据里的问题
+batch_searcher = BatchGreedySearchDecoder(encoder, decoder)
+sample_questions = [pairs[i][0] for i in range(min(5, len(pairs)))]
+for question, reply in zip(sample_questions, evaluateBatch(batch_searcher, voc, sample_questions, cache=response_cache)):
+    print('> {}\nBot: {}'.format(question, ' '.join(reply)))
+# 同样的问题再解码一次，这次都会命中缓存
+evaluateBatch(batch_searcher, voc, sample_questions, cache=response_cache)
+print('Cache hit rate: {:.2f}'.format(response_cache.hitRate()))
+
+# 使用beam search解码
+beam_size = 5
+beam_searcher = BeamSearchDecoder(encoder, decoder, beam_size)
+for question, reply in zip(sample_questions, evaluateBatch(beam_searcher, voc, sample_questions)):
+    print('> {}\nBot(beam): {}'.format(question, ' '.join(reply)))
+
+# 如果serve是True，那么启动HTTP服务器批量的处理请求，否则从终端读取输入进行测试
+serve = False
+serve_host = '127.0.0.1'
+serve_port = 8000
+# Unix socket的路径，不是None的时候监听它而不是serve_host和serve_port
+serve_socket = None
+max_batch_size = 32
+max_wait = 0.005
+
+if serve:
+    serveChat(batch_searcher, voc, serve_host, serve_port, serve_socket, max_batch_size, max_wait, response_cache)
+else:
+    # 测试
+    evaluateInput(encoder, decoder, searcher, voc, cache=response_cache)
+    print('Cache hits: {}; misses: {}'.format(response_cache.hits, response_cache.misses))
+
+
+# ### 导出TorchScript
+# 
+# 上面的解码在每个时刻都要通过Python调用decoder的各个层，而且加载模型需要这个文件里所有的代码(包括训练和数据处理的代码)。
+# 我们可以把encoder、decoder和贪心解码一起导出成一个TorchScript模块，它可以不依赖这个文件被加载(甚至可以在C++里加载)，解码的循环也不需要Python解释器。
+# 
+# - encoder里有``pack_padded_sequence``，decoder的forward有很多可选的参数，它们用``torch.jit.trace``导出。``DecoderStep``把decoder包装成固定参数的forward(一个时刻的解码，返回softmax之后的概率)和precompute(注意力的keys)，然后用``torch.jit.trace_module``同时trace这两个方法。
+# - 解码的循环有条件判断(遇到EOS就停止)，trace没有办法记录，因此``ScriptGreedySearchDecoder``用``torch.jit.script``导出。它一次解码一个句子，和``GreedySearchDecoder``的结果一样，但是遇到EOS就会停止。
+# - 词典和解码的配置(特殊词的ID和max_length)通过``_extra_files``保存在同一个文件里。
+# 
+# chatbot_runtime.py是一个只依赖PyTorch的最小的运行时，它有自己的normalizeString，用``python chatbot_runtime.py 模型文件``就可以和导出的模型对话。
+# 最后我们比较一下eager(也就是普通的Python执行)和TorchScript版本生成每个词的平均延迟。
+# 
+# 
+
+# In[ ]:
+
+
+# 把decoder包装成trace需要的固定参数的形式
+class DecoderStep(nn.Module):
+    def __init__(self, decoder):
+        super(DecoderStep, self).__init__()
+        self.decoder = decoder
+
+    def forward(self, input_step, last_hidden, encoder_outputs, encoder_keys):
+        return self.decoder(input_step, last_hidden, encoder_outputs, encoder_keys=encoder_keys)
+
+    def precompute(self, encoder_outputs):
+        return self.decoder.precompute(encoder_outputs)
+
+
+# 可以被torch.jit.script编译的贪心解码，encoder和decoder可以是普通的模块，也可以是trace之后的模块
+class ScriptGreedySearchDecoder(nn.Module):
+    def __init__(self, encoder, decoder, decoder_n_layers):
+        super(ScriptGreedySearchDecoder, self).__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+        self.decoder_n_layers = decoder_n_layers
+        self.sos_token = SOS_token
+        self.eos_token = EOS_token
+
+    def forward(self, input_seq: torch.Tensor, input_length: torch.Tensor, max_length: int):
+        encoder_outputs, encoder_hidden = self.encoder(input_seq, input_length)
+        decoder_hidden = encoder_hidden[:self.decoder_n_layers]
+        encoder_keys = self.decoder.precompute(encoder_outputs)
+        decoder_input = torch.full((1, 1), self.sos_token, dtype=torch.long, device=input_seq.device)
+        all_tokens = torch.zeros([max_length], dtype=torch.long, device=input_seq.device)
+        all_scores = torch.zeros([max_length], device=input_seq.device)
+        length = 0
+        for t in range(max_length):
+            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs, encoder_keys)
+            decoder_scores, decoder_input = torch.max(decoder_output, dim=1)
+            all_tokens[t] = decoder_input[0]
+            all_scores[t] = decoder_scores[0]
+            length = t + 1
+            if bool(decoder_input[0] == self.eos_token):
+                break
+            decoder_input = decoder_input.unsqueeze(0)
+        return all_tokens[:length], all_scores[:length]
+
+
+# 把encoder和decoder(在CPU上)导出成一个TorchScript文件，同时保存词典
+def exportScript(encoder, decoder, voc, filename, max_length=MAX_LENGTH):
+    encoder = copy.deepcopy(encoder).cpu().eval()
+    step = DecoderStep(copy.deepcopy(decoder).cpu().eval())
+    # trace用的输入，shape和解码的时候一样：(input_lengths, 1)的输入，(n_layers, 1, hidden_size)的隐状态
+    example_seq = torch.randint(EOS_token + 1, voc.num_words, (5, 1))
+    example_seq[-1] = EOS_token
+    example_length = torch.tensor([example_seq.size(0)])
+    with torch.no_grad():
+        traced_encoder = torch.jit.trace(encoder, (example_seq, example_length))
+        encoder_outputs, encoder_hidden = encoder(example_seq, example_length)
+        encoder_keys = step.precompute(encoder_outputs)
+        example_input = torch.full((1, 1), SOS_token, dtype=torch.long)
+        traced_decoder = torch.jit.trace_module(step, {
+            'forward': (example_input, encoder_hidden[:decoder.n_layers], encoder_outputs, encoder_keys),
+            'precompute': (encoder_outputs,),
+        })
+    scripted = torch.jit.script(ScriptGreedySearchDecoder(traced_encoder, traced_decoder, decoder.n_layers))
+    config = {'max_length': max_length, 'PAD_token': PAD_token, 'SOS_token': SOS_token, 'EOS_token': EOS_token}
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    torch.jit.save(scripted, filename, _extra_files={
+        'voc.txt': '\n'.join(voc.index2word),
+        'config.json': json.dumps(config),
+    })
+    return scripted
+
+
+# 比较eager和TorchScript的贪心解码，返回每个词的平均延迟(秒)。
+# 两个版本使用同样的参数，因此解码的结果应该完全一样。
+def benchmarkScript(eager, scripted, voc, sentences, max_length=MAX_LENGTH, repeat=3):
+    inputs = []
+    for sentence in sentences:
+        try:
+            indexes = indexesFromSentence(voc, sentence)
+        except KeyError:
+            continue
+        inputs.append((torch.LongTensor(indexes).view(-1, 1), torch.tensor([len(indexes)])))
+    latency = {}
+    with torch.no_grad():
+        for name, searcher in [('eager', eager), ('scripted', scripted)]:
+            # 预热，TorchScript在开始的几次调用会进行优化
+            for input_seq, input_length in inputs[:2]:
+                searcher(input_seq, input_length, max_length)
+            n_tokens = 0
+            start = time.time()
+            for _ in range(repeat):
+                for input_seq, input_length in inputs:
+                    tokens, _ = searcher(input_seq, input_length, max_length)
+                    n_tokens += tokens.size(0)
+            latency[name] = (time.time() - start) / max(n_tokens, 1)
+        same = all(torch.equal(eager(input_seq, input_length, max_length)[0],
+                               scripted(input_seq, input_length, max_length)[0])
+                   for input_seq, input_length in inputs)
+    print('Per-token latency eager: {:.3f}ms; scripted: {:.3f}ms; same replies: {}'.format(
+        latency['eager'] * 1000, latency['scripted'] * 1000, same))
+    return latency
+
+
+# In[ ]:
+
+
+# 导出的文件
+script_filename = os.path.join(save_dir, model_name, corpus_name, 'chatbot_scripted.pt')
+scripted_searcher = exportScript(encoder, decoder, voc, script_filename)
+print('Exported TorchScript model to', script_filename)
+
+# eager版本使用同样的解码代码，只是不进行trace和script
+eager_searcher = ScriptGreedySearchDecoder(copy.deepcopy(encoder).cpu(), DecoderStep(copy.deepcopy(decoder).cpu()),
+                                           decoder.n_layers)
+benchmarkScript(eager_searcher, scripted_searcher, voc, [pairs[i][0] for i in range(min(50, len(pairs)))])
+
+
+# ### int8动态量化
+# 
+# 在CPU上解码的时候，大部分时间花在encoder和decoder的GRU以及输出层``out``(500 x 词典大小的全连接层)上。
+# PyTorch的动态量化(``torch.quantization.quantize_dynamic``)把这些层的参数变成int8，计算的时候再动态的把输入量化成int8，
+# 然后使用int8的矩阵乘法，这样模型大小大约变成原来的1/4，在CPU上的速度也更快，而且不需要重新训练。
+# 
+# ``quantizeModel``把encoder和decoder的GRU和Linear层量化，embedding保持不变。concat注意力的``precompute``需要直接使用``self.attn.weight``的两半，
+# 量化之后的Linear层没有这个参数，因此这种情况下注意力的Linear层不进行量化。量化只支持CPU，因此量化后的模型总是在CPU上。
+# ``saveQuantized``和``loadQuantized``保存和加载量化的模型，``compareQuantized``在一些输入上比较fp32和int8模型每个回复的延迟、模型的大小以及回复相同的比例。
+# 
+# 
+
+# In[ ]:
+
+
+# 返回量化之后的encoder和decoder(在CPU上)，原来的模型不变
+def quantizeModel(encoder, decoder):
+    # 一起复制，这样encoder和decoder仍然共享同一个embedding
+    encoder, decoder = copy.deepcopy((encoder, decoder))
+    encoder = encoder.cpu().eval()
+    decoder = decoder.cpu().eval()
+    layers = {nn.GRU, nn.Linear}
+    torch.quantization.quantize_dynamic(encoder, layers, dtype=torch.qint8, inplace=True)
+    names = {name for name, module in decoder.named_modules()
+             if type(module) in layers and not (decoder.attn.method == 'concat' and name.startswith('attn'))}
+    torch.quantization.quantize_dynamic(decoder, names, dtype=torch.qint8, inplace=True)
+    return encoder, decoder
+
+
+def saveQuantized(encoder, decoder, voc, filename):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    torch.save({
+        'en': encoder.state_dict(),
+        'de': decoder.state_dict(),
+        'voc': voc.toBytes(),
+        'attn_model': decoder.attn.method,
+        'adaptive_softmax': isinstance(decoder.out, AdaptiveSoftmaxHead),
+    }, filename)
+
+
+# 构造同样结构的模型并且量化，然后加载保存的参数
+def loadQuantized(filename, hidden_size, encoder_n_layers, decoder_n_layers):
+    checkpoint = torch.load(filename, map_location=torch.device('cpu'), weights_only=False)
+    voc = Voc.fromBytes(checkpoint['voc'])
+    embedding = nn.Embedding(voc.num_words, hidden_size)
+    encoder = EncoderRNN(hidden_size, embedding, encoder_n_layers)
+    decoder = LuongAttnDecoderRNN(checkpoint['attn_model'], embedding, hidden_size, voc.num_words, decoder_n_layers,
+                                  counts=targetCounts(voc) if checkpoint['adaptive_softmax'] else None)
+    encoder, decoder = quantizeModel(encoder, decoder)
+    encoder.load_state_dict(checkpoint['en'])
+    decoder.load_state_dict(checkpoint['de'])
+    return encoder, decoder, voc
+
+
+# 模型序列化之后的大小(字节)，共享的embedding只计算一次
+def modelSize(encoder, decoder):
+    buffer = io.BytesIO()
+    torch.save({'en': encoder.state_dict(), 'de': decoder.state_dict()}, buffer)
+    return buffer.tell()
+
+
+# 一个一个的解码sentences，比较fp32和int8模型的延迟、大小以及回复的一致性
+def compareQuantized(encoder, decoder, quantized_encoder, quantized_decoder, voc, sentences, max_length=MAX_LENGTH):
+    fp32_searcher = BatchGreedySearchDecoder(encoder, decoder)
+    int8_searcher = BatchGreedySearchDecoder(quantized_encoder, quantized_decoder)
+    # 预热
+    evaluateBatch(fp32_searcher, voc, sentences[:2], max_length)
+    evaluateBatch(int8_searcher, voc, sentences[:2], max_length)
+    latency = {}
+    replies = {}
+    for name, searcher in [('fp32', fp32_searcher), ('int8', int8_searcher)]:
+        start = time.time()
+        replies[name] = [evaluateBatch(searcher, voc, [sentence], max_length)[0] for sentence in sentences]
+        latency[name] = (time.time() - start) / max(len(sentences), 1)
+    compared = [(a, b) for a, b in zip(replies['fp32'], replies['int8']) if a is not None]
+    agreement = sum(a == b for a, b in compared) / max(len(compared), 1)
+    fp32_size = modelSize(encoder, decoder)
+    int8_size = modelSize(quantized_encoder, quantized_decoder)
+    print('Latency per reply fp32: {:.2f}ms; int8: {:.2f}ms; speedup: {:.2f}x'.format(
+        latency['fp32'] * 1000, latency['int8'] * 1000, latency['fp32'] / latency['int8']))
+    print('Model size fp32: {:.1f}MB; int8: {:.1f}MB'.format(fp32_size / 2 ** 20, int8_size / 2 ** 20))
+    print('Same replies: {:.1%} of {} inputs'.format(agreement, len(compared)))
+    return {'latency': latency, 'size': {'fp32': fp32_size, 'int8': int8_size}, 'agreement': agreement}
+
+
+# In[ ]:
+
+
+# 量化当前的模型(比如从loadFilename加载的checkpoint)并保存
+quantized_filename = os.path.join(save_dir, model_name, corpus_name, 'chatbot_qint8.tar')
+quantized_encoder, quantized_decoder = quantizeModel(encoder, decoder)
+saveQuantized(quantized_encoder, quantized_decoder, voc, quantized_filename)
+print('Saved quantized model to', quantized_filename)
+
+# 量化的模型只能在CPU上运行，而searcher会把输入放到device上，因此只在CPU上比较
+if device.type == 'cpu':
+    # 随机选择一些训练数据里的问题作为评测的输入
+    eval_questions = [pairs[i][0] for i in random.Random(0).sample(range(len(pairs)), min(200, len(pairs)))]
+    compareQuantized(encoder, decoder, quantized_encoder, quantized_decoder, voc, eval_questions)
 
 
 # ## 结论